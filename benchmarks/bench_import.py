@@ -0,0 +1,67 @@
+"""Guard the import time of seg_writer and check that heavy dependencies load lazily.
+
+Usage: python benchmarks/bench_import.py --runs 10 --budget-ms 50
+
+Every statement is timed in fresh interpreters (median of `--runs`). The
+script exits with status 1 if `import seg_writer` exceeds the budget or if
+any statement imports one of the heavy dependencies, so it can run as a
+check in CI.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Imported by the first conversion, never by importing the package
+HEAVY_MODULES = ("pydicom", "highdicom", "SimpleITK", "nibabel", "palettable", "pydicom.sr.codedict")
+
+# Statements timed, the first one is held to the budget
+STATEMENTS = (
+    "import seg_writer",
+    "from seg_writer.Writer import Writer",
+    "from seg_writer.AsyncWriter import AsyncWriter",
+    "import seg_writer.__main__",
+    "from seg_writer.tools.create_metadata import create_metadata",
+)
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+exec({statement!r})
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+# Time one statement in a fresh interpreter
+def measure(statement):
+    probe = _PROBE.format(statement=statement, heavy=HEAVY_MODULES)
+    output = subprocess.run([sys.executable, "-c", probe], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float, default=50.0, help="budget for 'import seg_writer'")
+    args = parser.parse_args()
+
+    failures = []
+    for index, statement in enumerate(STATEMENTS):
+        results = [measure(statement) for _ in range(args.runs)]
+        median_ms = statistics.median(result["seconds"] for result in results) * 1000
+        loaded = sorted({module for result in results for module in result["loaded"]})
+        print(f"{statement:<62} {median_ms:8.1f} ms  heavy modules: {', '.join(loaded) or 'none'}")
+        if loaded:
+            failures.append(f"'{statement}' imports {', '.join(loaded)}")
+        if index == 0 and median_ms > args.budget_ms:
+            failures.append(f"'{statement}' took {median_ms:.1f} ms, budget is {args.budget_ms:.1f} ms")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+"""Time the conversion pipeline end to end and per stage on synthetic studies.
+
+Usage: python benchmarks/bench_pipeline.py --slices 120 --rows 256 --columns 256 --labels 40 --output results.json
+
+A CT series, a label map (NIfTI and numpy, slice axis at `--slice-axis`),
+the metadata JSON and a label CSV are generated offline from `--seed`. Each
+target runs `--warmup` times untimed and `--repeat` times timed; the report
+holds the median wall time, voxels per second, studies per minute, peak RSS
+and, for the Writer methods, the median of every stage. With `--compare`
+the medians are checked against an earlier report and the script exits
+with status 1 if a target got slower than `--tolerance` allows.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from synthetic import make_study
+
+import seg_writer
+from seg_writer.Writer import Writer
+from seg_writer.metrics import TimingReport, memory_usage, reset_peak_memory
+from seg_writer.tools.create_metadata import create_metadata
+from seg_writer.utils import compress_dicom, reorient_pixel_array
+
+TARGETS = ("from_nifti", "from_array", "reorient_pixel_array", "compress_dicom", "create_metadata")
+
+
+# Zero-argument callables for every target; Writer targets also take the metrics callable
+def prepare_targets(study, workdir, args):
+    writer = Writer()
+    array = study.array()
+    options = dict(encoding=args.encoding, workers=args.workers)
+
+    # compress_dicom deflates an uncompressed SEG written once up front
+    explicit_seg = writer.from_array(array, study.dicom_series_path, study.metadata_file_path,
+                                     os.path.join(workdir, "explicit"), encoding="explicit")
+
+    return {
+        "from_nifti": lambda metrics: writer.from_nifti(
+            study.nifti_file_path, study.dicom_series_path, study.metadata_file_path,
+            os.path.join(workdir, "from_nifti"), slab_size=args.slab_size, metrics=metrics, **options),
+        "from_array": lambda metrics: writer.from_array(
+            array, study.dicom_series_path, study.metadata_file_path,
+            os.path.join(workdir, "from_array"), metrics=metrics, **options),
+        "reorient_pixel_array": lambda metrics: np.ascontiguousarray(
+            reorient_pixel_array(study.nifti_file_path, study.dicom_series_path)),
+        "compress_dicom": lambda metrics: compress_dicom(explicit_seg, os.path.join(workdir, "deflated.dcm")),
+        "create_metadata": lambda metrics: create_metadata(
+            study.nifti_file_path, study.csv_file_path, os.path.join(workdir, "metadata.json")),
+    }
+
+
+# Peak resident set size of the process in bytes since the last reset
+def peak_rss():
+    usage = memory_usage()
+    if usage is not None:
+        return usage[1]
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def run_target(name, target, voxels, args):
+    for _ in range(args.warmup):
+        with contextlib.redirect_stdout(io.StringIO()):
+            target(None)
+
+    seconds, peaks, stages = [], [], {}
+    for _ in range(args.repeat):
+        report = TimingReport()
+        reset_peak_memory()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            target(report)
+        seconds.append(time.perf_counter() - start)
+        peaks.append(peak_rss())
+        for stage in report.stages:
+            stages.setdefault(stage.stage, []).append(stage)
+
+    median = statistics.median(seconds)
+    return {
+        "target": name,
+        "seconds": median,
+        "runs": seconds,
+        "voxels_per_second": voxels / median,
+        "studies_per_minute": 60 / median,
+        "peak_rss_bytes": max(peaks),
+        "stages": {
+            stage: {
+                "seconds": statistics.median(m.seconds for m in measured),
+                "peak_memory": max((m.peak_memory for m in measured if m.peak_memory is not None), default=None),
+                "bytes_read": max((m.bytes_read for m in measured if m.bytes_read is not None), default=None),
+                "bytes_written": max((m.bytes_written for m in measured if m.bytes_written is not None), default=None),
+            }
+            for stage, measured in stages.items()
+        },
+    }
+
+
+# Targets slower than the baseline report by more than `tolerance`
+def regressions(results, baseline_path, tolerance):
+    with open(baseline_path) as file:
+        baseline = {result["target"]: result for result in json.load(file)["results"]}
+    failures = []
+    for result in results:
+        previous = baseline.get(result["target"])
+        if previous is not None and result["seconds"] > previous["seconds"] * (1 + tolerance):
+            failures.append(f"{result['target']}: {result['seconds']:.3f}s, baseline {previous['seconds']:.3f}s")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--slices", type=int, default=64)
+    parser.add_argument("--rows", type=int, default=128)
+    parser.add_argument("--columns", type=int, default=128)
+    parser.add_argument("--labels", type=int, default=20)
+    parser.add_argument("--slice-axis", type=int, choices=(0, 1, 2), default=2,
+                        help="position of the slice axis in the NIfTI and numpy label maps")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--encoding", default="deflate")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--slab-size", type=int, default=None, help="stream from_nifti in slabs of this many slices")
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=TARGETS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--workdir", help="directory for the generated study and outputs, defaults to a temporary one")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="JSON report of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against --compare")
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        workdir = args.workdir or stack.enter_context(tempfile.TemporaryDirectory(prefix="seg_writer_bench_"))
+        study = make_study(os.path.join(workdir, "study"), args.slices, args.rows, args.columns,
+                           args.labels, args.slice_axis, args.seed)
+        targets = prepare_targets(study, workdir, args)
+
+        results = []
+        for name in args.targets:
+            result = run_target(name, targets[name], study.voxels, args)
+            results.append(result)
+            print(f"{name:<22} {result['seconds']:8.3f} s  {result['voxels_per_second'] / 1e6:8.1f} Mvox/s  "
+                  f"{result['studies_per_minute']:8.1f} studies/min  peak RSS {result['peak_rss_bytes'] / 2**20:7.0f} MB",
+                  file=sys.stderr)
+
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "workdir")},
+        "environment": {
+            "seg_writer": seg_writer.__version__,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        failures = regressions(results, args.compare, args.tolerance)
+        for failure in failures:
+            print(f"FAIL: {failure}", file=sys.stderr)
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""Compare the affine-based reorientation engine with the legacy per-voxel loops.
+
+Usage: python benchmarks/bench_reorient.py --size 256 --slices 120
+
+The legacy implementation is reproduced here on in-memory arrays so both
+paths see exactly the same input. The synthetic volume uses the LAS layout
+written by dcm2niix, which is the layout the legacy loops were built for.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from seg_writer.orientation import dicom_affine, reorient_to_dicom
+
+
+# Legacy reorient_pixel_array body, operating on arrays instead of files
+def legacy_reorient(nifti_data, affine_matrix, dicom_positions):
+    dicom_shape = len(dicom_positions)
+    nifti_shape = nifti_data.shape
+    nifti_positions = np.array([affine_matrix @ np.array([0, 0, i, 1]) for i in range(nifti_shape[2])])[:, :3]
+    slice_axis = np.argmax([nifti_shape[0] == dicom_shape,
+                            nifti_shape[1] == dicom_shape,
+                            nifti_shape[2] == dicom_shape])
+    segment_array = np.zeros((dicom_shape, nifti_shape[0], nifti_shape[1]), dtype=np.uint8)
+    if slice_axis == 1:
+        for i in range(nifti_data.shape[1]):
+            for x in range(nifti_data.shape[0]):
+                for y in range(nifti_data.shape[2]):
+                    segment_array[i, x, y] = nifti_data[x, i, y]
+    elif slice_axis == 2:
+        for i in range(nifti_data.shape[2]):
+            for x in range(nifti_data.shape[0]):
+                for y in range(nifti_data.shape[1]):
+                    segment_array[i, x, y] = nifti_data[x, y, i]
+    else:
+        segment_array = nifti_data
+    if np.linalg.norm(nifti_positions[0] - dicom_positions[0]) > np.linalg.norm(nifti_positions[-1] - dicom_positions[0]):
+        segment_array = segment_array[::-1]
+    return np.rot90(segment_array, k=1, axes=(1, 2))
+
+
+def synthetic_case(size, slices, labels, seed=0):
+    rng = np.random.default_rng(seed)
+    spacing = (0.8, 0.8, 1.5)
+    origin = (-100.0, -120.0, -300.0)
+    # Axial LPS series with (column, row, slice) direction cosines as columns
+    dicom_matrix = dicom_affine(origin, np.eye(3), spacing)
+    # LAS NIfTI: i runs along DICOM columns, j against DICOM rows
+    las_to_dicom_index = np.array([
+        [1, 0, 0, 0],
+        [0, -1, 0, size - 1],
+        [0, 0, 1, 0],
+        [0, 0, 0, 1],
+    ], dtype=np.float64)
+    nifti_affine = np.diag([-1.0, -1.0, 1.0, 1.0]) @ dicom_matrix @ las_to_dicom_index
+    data = rng.integers(0, labels + 1, size=(size, size, slices), dtype=np.uint8)
+    positions = np.array([dicom_matrix @ np.array([0, 0, k, 1]) for k in range(slices)])[:, :3]
+    return data, nifti_affine, dicom_matrix, positions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=128, help="rows and columns of the synthetic volume")
+    parser.add_argument("--slices", type=int, default=64)
+    parser.add_argument("--labels", type=int, default=20)
+    parser.add_argument("--skip-legacy", action="store_true", help="only time the new engine")
+    args = parser.parse_args()
+
+    data, nifti_affine, dicom_matrix, positions = synthetic_case(args.size, args.slices, args.labels)
+    voxels = data.size
+
+    start = time.perf_counter()
+    result = reorient_to_dicom(data, nifti_affine, dicom_matrix, (args.size, args.size, args.slices))
+    result = np.ascontiguousarray(result)
+    engine_seconds = time.perf_counter() - start
+    print(f"engine: {engine_seconds:.4f}s ({voxels / engine_seconds / 1e6:.1f} Mvox/s)")
+
+    if args.skip_legacy:
+        return
+
+    start = time.perf_counter()
+    expected = legacy_reorient(data, nifti_affine, positions)
+    legacy_seconds = time.perf_counter() - start
+    print(f"legacy: {legacy_seconds:.4f}s ({voxels / legacy_seconds / 1e6:.3f} Mvox/s)")
+    print(f"speedup: {legacy_seconds / engine_seconds:.0f}x")
+
+    if not np.array_equal(result, expected):
+        raise SystemExit("engine and legacy results differ")
+    print("results identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Compare the streamed writer with the in-memory conversion it replaces.
+
+Usage: python benchmarks/bench_streaming.py --slices 64 --rows 35 --columns 37 --slab-sizes 1 8 64
+
+`write_streamed_segmentation` writes the SEG element by element, with
+hand-made sequence and pixel data headers, frames bit-packed across byte
+boundaries and offset tables. Each encoding is converted once in memory and
+once per slab size, streamed; every element but the generated UIDs and
+times, and the decoded frames, have to be identical. The default frame
+size of 35 x 37 is not a multiple of 8, so bit-packed frames share bytes.
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+import numpy as np
+import pydicom
+
+from synthetic import make_study
+
+from seg_writer.Writer import Writer
+
+# Encodings and segmentation types compared; BINARY SEGs are bit-packed unless JPEG 2000 compressed
+CASES = (
+    ("deflate", "BINARY"),
+    ("explicit", "BINARY"),
+    ("jpeg2000", "BINARY"),
+    ("explicit", "FRACTIONAL"),
+    ("rle", "FRACTIONAL"),
+)
+
+# Elements generated anew by every conversion; the contributing equipment holds the contribution time
+GENERATED = {
+    "SOPInstanceUID", "ContentDate", "ContentTime", "InstanceCreationDate", "InstanceCreationTime",
+    "DimensionOrganizationSequence", "DimensionIndexSequence", "ContributingEquipmentSequence",
+}
+
+
+# Keywords of the elements in which two SEGs differ, apart from generated ones
+def differences(expected, streamed):
+    return [element.keyword for element in expected
+            if element.keyword not in GENERATED
+            and (element.tag not in streamed or streamed[element.tag].value != element.value)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--slices", type=int, default=64)
+    parser.add_argument("--rows", type=int, default=35)
+    parser.add_argument("--columns", type=int, default=37)
+    parser.add_argument("--labels", type=int, default=10)
+    parser.add_argument("--slice-axis", type=int, default=2, choices=(0, 1, 2))
+    parser.add_argument("--slab-sizes", type=int, nargs="+", default=[1, 8, 64])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as workdir:
+        study = make_study(workdir, args.slices, args.rows, args.columns, args.labels, args.slice_axis, args.seed)
+        writer = Writer()
+        for encoding, segmentation_type in CASES:
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                expected = writer.from_nifti(study.nifti_file_path, study.dicom_series_path, study.metadata_file_path,
+                                             None, encoding=encoding, segmentation_type=segmentation_type)
+                memory_seconds = time.perf_counter() - start
+            expected = pydicom.dcmread(io.BytesIO(expected))
+
+            for slab_size in args.slab_sizes:
+                output = os.path.join(workdir, f"{encoding}_{segmentation_type}_{slab_size}")
+                with contextlib.redirect_stdout(io.StringIO()):
+                    start = time.perf_counter()
+                    streamed = writer.from_nifti(study.nifti_file_path, study.dicom_series_path,
+                                                 study.metadata_file_path, output, encoding=encoding,
+                                                 segmentation_type=segmentation_type, slab_size=slab_size)
+                    streamed_seconds = time.perf_counter() - start
+                streamed = pydicom.dcmread(streamed)
+
+                problems = differences(expected, streamed)
+                if streamed.file_meta.TransferSyntaxUID != expected.file_meta.TransferSyntaxUID:
+                    problems.append("TransferSyntaxUID")
+                if not np.array_equal(streamed.pixel_array, expected.pixel_array):
+                    problems.append("frames")
+                failed = failed or bool(problems)
+                print(f"{encoding:>8} {segmentation_type:<10} slab {slab_size:>4}: in memory {memory_seconds:.4f}s, "
+                      f"streamed {streamed_seconds:.4f}s, {'differs in ' + ', '.join(problems) if problems else 'identical'}")
+
+    if failed:
+        raise SystemExit("streamed and in-memory results differ")
+    print("results identical")
+
+
+if __name__ == "__main__":
+    main()
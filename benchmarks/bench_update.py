@@ -0,0 +1,84 @@
+"""Compare updating a SEG with converting it again, and check the stored segment hashes.
+
+Usage: python benchmarks/bench_update.py --slices 120 --rows 256 --columns 256 --labels 40
+
+A synthetic study is converted once, then one label is removed and the
+SEG is updated. The update has to give the pixels a full conversion gives,
+and be faster than it; each is timed as the best of `--runs` runs.
+Building a second SEG from the same metadata file must not change the
+segment hashes of a SEG built before it, as later updates trust them.
+"""
+import argparse
+import contextlib
+import io
+import tempfile
+import time
+
+import numpy as np
+import pydicom
+
+from synthetic import make_study
+
+from seg_writer.Writer import Writer
+from seg_writer.hashes import get_segment_hashes
+from seg_writer.series import SourceSeries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--slices", type=int, default=64)
+    parser.add_argument("--rows", type=int, default=128)
+    parser.add_argument("--columns", type=int, default=128)
+    parser.add_argument("--labels", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        study = make_study(workdir, args.slices, args.rows, args.columns, args.labels, seed=args.seed)
+        writer = Writer()
+        label_map = study.array()
+        changed = label_map.copy()
+        changed[changed == 1] = 0
+
+        # Two SEG datasets built one after the other from the same metadata file
+        series = SourceSeries.from_path(study.dicom_series_path)
+        first = writer._create_segmentation(study.label_map, series.datasets,
+                                            writer.filter_segment_descriptions(study.metadata_file_path),
+                                            "BINARY", pydicom.uid.ExplicitVRLittleEndian, None)
+        stored = get_segment_hashes(first)
+        writer._create_segmentation(np.moveaxis(changed, study.slice_axis, 0), series.datasets,
+                                    writer.filter_segment_descriptions(study.metadata_file_path),
+                                    "BINARY", pydicom.uid.ExplicitVRLittleEndian, None)
+        if get_segment_hashes(first) != stored:
+            raise SystemExit("a later conversion changed the segment hashes of an earlier SEG")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            previous = writer.from_array(label_map, study.dicom_series_path, study.metadata_file_path, workdir)
+
+            full_seconds = update_seconds = float("inf")
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                full = writer.from_array(changed, study.dicom_series_path, study.metadata_file_path, None)
+                full_seconds = min(full_seconds, time.perf_counter() - start)
+
+                start = time.perf_counter()
+                updated = writer.update_from_array(previous, changed, study.dicom_series_path, study.metadata_file_path, None)
+                update_seconds = min(update_seconds, time.perf_counter() - start)
+
+        print(f"full conversion: {full_seconds:.4f}s")
+        print(f"update: {update_seconds:.4f}s ({full_seconds / update_seconds:.1f}x)")
+
+        full_seg = pydicom.dcmread(io.BytesIO(full))
+        updated_seg = pydicom.dcmread(io.BytesIO(updated))
+        if get_segment_hashes(updated_seg) != get_segment_hashes(full_seg):
+            raise SystemExit("update and full conversion store different segment hashes")
+        if not np.array_equal(updated_seg.pixel_array, full_seg.pixel_array):
+            raise SystemExit("update and full conversion differ")
+        print("results identical")
+        if update_seconds >= full_seconds:
+            raise SystemExit("the update is not faster than a full conversion")
+
+
+if __name__ == "__main__":
+    main()
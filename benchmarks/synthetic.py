@@ -0,0 +1,161 @@
+"""Synthetic CT series, label maps and metadata for the benchmarks.
+
+Everything is generated offline from a seed, UIDs included, so two runs
+with the same arguments convert identical studies.
+"""
+import csv
+import json
+import os
+
+import numpy as np
+
+from seg_writer.orientation import dicom_affine
+from seg_writer.utils import find_package_directory
+
+# Example metadata shipped with the package, one entry per TotalSegmentator label
+EXAMPLE_METADATA = os.path.join("examples", "total segmentator metadata", "ct_meta.json")
+
+# Order of the DICOM (column, row, slice) axes in the NIfTI array for each slice axis position
+NIFTI_AXES = {
+    0: ("slice", "column", "row"),
+    1: ("column", "slice", "row"),
+    2: ("column", "row", "slice"),
+}
+
+# Axis of a (slices, rows, columns) array holding each DICOM axis
+_VOLUME_AXIS = {"slice": 0, "row": 1, "column": 2}
+_INDEX_AXIS = {"column": 0, "row": 1, "slice": 2}
+
+
+class SyntheticStudy:
+    """Paths and geometry of one generated study."""
+
+    def __init__(self, directory, label_map, dicom_matrix, slice_axis):
+        self.directory = directory
+        self.label_map = label_map
+        self.dicom_matrix = dicom_matrix
+        self.slice_axis = slice_axis
+        self.dicom_series_path = os.path.join(directory, "dicom")
+        self.nifti_file_path = os.path.join(directory, "labels.nii.gz")
+        self.metadata_file_path = os.path.join(directory, "metadata.json")
+        self.csv_file_path = os.path.join(directory, "labels.csv")
+
+    @property
+    def voxels(self):
+        return self.label_map.size
+
+    def array(self):
+        """The label map with its slice axis at `slice_axis`, as passed to `Writer.from_array`."""
+        return np.moveaxis(self.label_map, 0, self.slice_axis)
+
+
+# Reproducible UIDs derived from the seed
+def _uid(seed, *parts):
+    from pydicom.uid import generate_uid
+
+    return generate_uid(entropy_srcs=[str(seed), *map(str, parts)])
+
+
+# Ellipsoid organs of random size, placed at random; later labels overwrite earlier ones
+def make_label_map(slices, rows, columns, labels, seed=0, dtype=np.uint8):
+    rng = np.random.default_rng(seed)
+    label_map = np.zeros((slices, rows, columns), dtype=dtype)
+    shape = np.array(label_map.shape)
+    for label in range(1, labels + 1):
+        radii = np.maximum(shape * rng.uniform(0.03, 0.15, size=3), 1)
+        center = rng.uniform(radii, shape - radii)
+        start = np.maximum(np.floor(center - radii).astype(int), 0)
+        stop = np.minimum(np.ceil(center + radii).astype(int) + 1, shape)
+        grid = np.ogrid[tuple(slice(a, b) for a, b in zip(start, stop))]
+        inside = sum(((axis - c) / r) ** 2 for axis, c, r in zip(grid, center, radii)) <= 1
+        label_map[tuple(slice(a, b) for a, b in zip(start, stop))][inside] = label
+    return label_map
+
+
+# Axial CT series with one file per slice; pixel data is blank, only the headers matter to the Writer
+def write_series(directory, slices, rows, columns, spacing=(0.8, 0.8), thickness=1.5, seed=0):
+    from pydicom.dataset import FileDataset, FileMetaDataset
+    from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian
+
+    os.makedirs(directory, exist_ok=True)
+    origin = (-spacing[1] * columns / 2, -spacing[0] * rows / 2, 0.0)
+    pixels = bytes(rows * columns * 2)
+    for index in range(slices):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = CTImageStorage
+        meta.MediaStorageSOPInstanceUID = _uid(seed, "instance", index)
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds = FileDataset(None, {}, file_meta=meta, preamble=b"\0" * 128)
+        ds.SOPClassUID = CTImageStorage
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.StudyInstanceUID = _uid(seed, "study")
+        ds.SeriesInstanceUID = _uid(seed, "series")
+        ds.FrameOfReferenceUID = _uid(seed, "frame")
+        ds.Modality = "CT"
+        ds.PatientID = f"SYNTHETIC{seed}"
+        ds.PatientName = "Synthetic^Study"
+        ds.PatientBirthDate = ""
+        ds.PatientSex = "O"
+        ds.StudyDate = "20240101"
+        ds.StudyTime = "120000"
+        ds.AccessionNumber = ""
+        ds.ReferringPhysicianName = ""
+        ds.StudyID = "1"
+        ds.SeriesNumber = 1
+        ds.InstanceNumber = index + 1
+        ds.ImagePositionPatient = [origin[0], origin[1], origin[2] + index * thickness]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = list(spacing)
+        ds.SliceThickness = thickness
+        ds.Rows = rows
+        ds.Columns = columns
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.PixelData = pixels
+        ds.save_as(os.path.join(directory, f"IM{index:05d}.dcm"), enforce_file_format=True)
+
+    # PixelSpacing is (row spacing, column spacing)
+    return dicom_affine(origin, np.eye(3), (spacing[1], spacing[0], thickness))
+
+
+# NIfTI label map with the slice axis at `slice_axis`, its affine derived from the DICOM grid
+def write_nifti(path, label_map, dicom_matrix, slice_axis=2):
+    import nibabel as nib
+
+    axes = NIFTI_AXES[slice_axis]
+    data = np.transpose(label_map, [_VOLUME_AXIS[axis] for axis in axes])
+    # Columns of the permutation map each NIfTI index onto a DICOM (column, row, slice) index
+    permutation = np.eye(4)
+    permutation[:3, :3] = np.eye(3)[:, [_INDEX_AXIS[axis] for axis in axes]]
+    lps_to_ras = np.diag([-1.0, -1.0, 1.0, 1.0])
+    nib.save(nib.Nifti1Image(data, lps_to_ras @ dicom_matrix @ permutation), path)
+
+
+# Segment metadata for labels 1..labels, taken from the TotalSegmentator example
+def write_metadata(metadata_path, csv_path, labels):
+    with open(os.path.join(find_package_directory(), EXAMPLE_METADATA)) as file:
+        metadata = json.load(file)
+    attributes = metadata["segmentAttributes"][0]
+    if labels > len(attributes):
+        raise ValueError(f"At most {len(attributes)} labels are described by the example metadata, not {labels}.")
+    metadata["segmentAttributes"] = [attributes[:labels]]
+    with open(metadata_path, "w") as file:
+        json.dump(metadata, file)
+    with open(csv_path, "w", newline="") as file:
+        writer = csv.writer(file)
+        for attribute in attributes[:labels]:
+            writer.writerow([attribute["labelID"], attribute["SegmentLabel"]])
+
+
+def make_study(directory, slices=64, rows=128, columns=128, labels=20, slice_axis=2, seed=0):
+    """Generate a source series, label map (NIfTI and in memory), metadata JSON and label CSV."""
+    label_map = make_label_map(slices, rows, columns, labels, seed)
+    study = SyntheticStudy(directory, label_map, None, slice_axis)
+    study.dicom_matrix = write_series(study.dicom_series_path, slices, rows, columns, seed=seed)
+    write_nifti(study.nifti_file_path, label_map, study.dicom_matrix, slice_axis)
+    write_metadata(study.metadata_file_path, study.csv_file_path, labels)
+    return study
@@ -0,0 +1,66 @@
+import asyncio
+import zlib
+
+from seg_writer.Writer import Writer
+from seg_writer.stages import run_stages_async
+
+
+class AsyncWriter:
+    """Awaitable `from_nifti` and `from_array` for asyncio applications.
+
+    A conversion runs as the stages of `Writer` (load, validate, build,
+    encode, write). The file system stages run in `io_executor`, the CPU
+    stages in `executor`; both default to the event loop's default executor
+    and have to be thread pools. At most `max_concurrency` conversions are in
+    flight, further calls wait for a free slot. The limiter belongs to the
+    first event loop that uses it.
+    """
+
+    def __init__(self, executor=None, io_executor=None, max_concurrency=4, writer=None):
+        if max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be at least 1, not {max_concurrency}")
+        self.writer = writer if writer is not None else Writer()
+        self.executor = executor
+        self.io_executor = io_executor
+        self._limiter = asyncio.Semaphore(max_concurrency)
+
+    async def from_nifti(self, nifti_file_path, dicom_series_path, metadata_file_path, output_path, compression_level=zlib.Z_DEFAULT_COMPRESSION,
+                         encoding="deflate", segmentation_type="BINARY", workers=None, slab_size=None, progress=None, metrics=None,
+                         max_frames=None, segment_groups=None, resample=None):
+        async with self._limiter:
+            return await run_stages_async(
+                self.writer._nifti_stages(nifti_file_path, dicom_series_path, metadata_file_path, output_path,
+                                          compression_level, encoding, segmentation_type, workers, slab_size,
+                                          max_frames, segment_groups, resample),
+                progress, self.executor, self.io_executor, metrics,
+            )
+
+    async def from_array(self, pixel_array, dicom_series_path, metadata_file_path, output_path, compression_level=zlib.Z_DEFAULT_COMPRESSION,
+                         encoding="deflate", segmentation_type="BINARY", workers=None, progress=None, metrics=None,
+                         max_frames=None, segment_groups=None):
+        async with self._limiter:
+            return await run_stages_async(
+                self.writer._array_stages(pixel_array, dicom_series_path, metadata_file_path, output_path,
+                                          compression_level, encoding, segmentation_type, workers,
+                                          max_frames, segment_groups),
+                progress, self.executor, self.io_executor, metrics,
+            )
+
+    async def update_from_nifti(self, seg_file_path, nifti_file_path, dicom_series_path, metadata_file_path, output_path,
+                                compression_level=zlib.Z_DEFAULT_COMPRESSION, workers=None, progress=None, metrics=None,
+                                resample=None):
+        async with self._limiter:
+            return await run_stages_async(
+                self.writer._update_nifti_stages(seg_file_path, nifti_file_path, dicom_series_path, metadata_file_path,
+                                                 output_path, compression_level, workers, resample),
+                progress, self.executor, self.io_executor, metrics,
+            )
+
+    async def update_from_array(self, seg_file_path, pixel_array, dicom_series_path, metadata_file_path, output_path,
+                                compression_level=zlib.Z_DEFAULT_COMPRESSION, workers=None, progress=None, metrics=None):
+        async with self._limiter:
+            return await run_stages_async(
+                self.writer._update_array_stages(seg_file_path, pixel_array, dicom_series_path, metadata_file_path,
+                                                 output_path, compression_level, workers),
+                progress, self.executor, self.io_executor, metrics,
+            )
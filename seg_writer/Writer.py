@@ -1,220 +1,530 @@
-import pydicom
-import SimpleITK as sitk
-import highdicom as hd
-from typing import List, Union
+from typing import List, Optional, Union
 from os import PathLike
-import json
-from highdicom import AlgorithmIdentificationSequence
-from pydicom.sr.codedict import codes
 import os
+import zlib
+from seg_writer.lazy import LazyModule
 from seg_writer.utils import *
+from seg_writer.series import SourceSeries
+from seg_writer.segmentation import LoadedSegmentation
+from seg_writer.labels import LabelIndex
+from seg_writer.catalog import load_catalog
+from seg_writer.stages import LOAD, RESAMPLE, VALIDATE, BUILD, ENCODE, WRITE, run_stages
+from seg_writer.metrics import measure
+from seg_writer.verify import VERIFY_FAST, check_verify_mode, verify_segmentation
 from concurrent.futures import ThreadPoolExecutor
 import gc
+import io
+import uuid
+
+# Heavy dependencies are imported on first use
+pydicom = LazyModule("pydicom")
+hd = LazyModule("highdicom")
 
 class Writer:
 
     AnyStr = Union[bytes, str]
     FSPath = Union[AnyStr, PathLike]
 
-    def __init__(self):
-        pass
+    # `header_cache` is an optional `HeaderCache` shared by conversions of the same source series,
+    # `verify` the check of every written SEG: "off", "fast" or "full"
+    def __init__(self, header_cache=None, verify=VERIFY_FAST):
+        self.header_cache = header_cache
+        self.verify = check_verify_mode(verify)
     
-    # Load nifti file and returns pixel values as numpy array
-    def _load_nifti_file(self,nifti_file_path):
-        sitk_image = sitk.ReadImage(nifti_file_path)
-        return sitk.GetArrayFromImage(sitk_image)
+    # Load nifti file once and return the decoded segmentation
+    def _load_nifti_file(self,nifti_file_path, label_map=True) -> LoadedSegmentation:
+        return LoadedSegmentation.from_file(nifti_file_path, label_map=label_map)
 
-    # Load segmentaion metadata json file
+    # Load segmentaion metadata json file, cached per file until it changes
     def read_metadata(self,metadata_file_path):
-        with open(metadata_file_path, 'r') as file:
-            return json.load(file)
+        return load_catalog(metadata_file_path).metadata
 
     # Filter segmentation filter and orginize it
-    def filter_segment_descriptions(self, metadata_file_path):
-        metadata = self.read_metadata(metadata_file_path)
-        segment_attributes = [item for sublist in metadata['segmentAttributes'] for item in sublist]
-        filtered_descriptions = []
-        for desc in segment_attributes:
-            #if desc['labelID'] in labels:
-            # Correctly create CodedConcept objects
-            category = hd.sr.CodedConcept(
-                value=desc['SegmentedPropertyCategoryCodeSequence']['CodeValue'],
-                scheme_designator=desc['SegmentedPropertyCategoryCodeSequence']['CodingSchemeDesignator'],
-                meaning=desc['SegmentedPropertyCategoryCodeSequence']['CodeMeaning']
-            )
-            type_code = hd.sr.CodedConcept(
-                value=desc['SegmentedPropertyTypeCodeSequence']['CodeValue'],
-                scheme_designator=desc['SegmentedPropertyTypeCodeSequence']['CodingSchemeDesignator'],
-                meaning=desc['SegmentedPropertyTypeCodeSequence']['CodeMeaning']
-            )
-            # Create the SegmentDescription objects
-            segment_description = hd.seg.SegmentDescription(
-                segment_number=desc['labelID'],
-                segment_label=desc['SegmentLabel'],
-                segmented_property_category=category,
-                segmented_property_type=type_code,
-                algorithm_type=hd.seg.SegmentAlgorithmTypeValues.AUTOMATIC.value,
-                algorithm_identification=AlgorithmIdentificationSequence(
-                    name='AI',  
-                    version='',  
-                    family=codes.cid7162.ArtificialIntelligence
-                )
-            )
-            filtered_descriptions.append(segment_description)
-        return filtered_descriptions
+    def filter_segment_descriptions(self, metadata_file_path, labels=None):
+        return load_catalog(metadata_file_path).descriptions(labels)
 
-    def _normalize_source_images(self, dcms_or_paths: Union[List[pydicom.Dataset], FSPath]) -> List[pydicom.Dataset]:
+    def _normalize_source_images(self, dcms_or_paths: Union[List["pydicom.Dataset"], FSPath], metrics=None) -> List["pydicom.Dataset"]:
         """Normalize source DICOM images, ensuring they have no 'NumberOfFrames' tag."""
+        return measure(LOAD, lambda: self._load_source_series(dcms_or_paths), metrics)().datasets
 
-        def process_dicom_file(elem):
-            if isinstance(elem, pydicom.Dataset):
-                # Check if 'NumberOfFrames' tag exists and delete it
-                if 'NumberOfFrames' in elem:
-                    del elem.NumberOfFrames
-                return elem
-            else:
-                dcm = pydicom.dcmread(elem, stop_before_pixels=True,force=True)
-                # Check if 'NumberOfFrames' tag exists and delete it
-                if 'NumberOfFrames' in dcm:
-                    del dcm.NumberOfFrames
-                return dcm
-
-        result: List[pydicom.Dataset] = []
-        dicom_series_files = [os.path.join(dcms_or_paths, i) for i in os.listdir(dcms_or_paths) if '.dcm' in i]
-
-        with ThreadPoolExecutor() as executor:
-            result = list(executor.map(process_dicom_file, dicom_series_files))
-
-        return result
-
-
-    def from_nifti(self,nifti_file_path, dicom_series_path, metadata_file_path, output_path):
-
-        # Check overlap
-        check_for_overlap(segmentation=nifti_file_path)
-        
-        # Load the NIfTI file to get the pixel data
-        pixel_array = self._load_nifti_file(nifti_file_path)
-
-        # Iterate on segmentation to check is lables present and if no lables presents return error and if found one return list of uniqe lables
-        get_nifti_labels(nifti_file_path)
-
-        # Normalize the source DICOM images
-        dicom_datasets = self._normalize_source_images(dicom_series_path)
-        
-        # Match the shape of segmentation and source dicom files
-        pixel_array = reorient_pixel_array(nifti_file_path,dicom_series_path)
-
-        # Read the metadata and filter the segment descriptions
-        #metadata = self.read_metadata(metadata_file_path)
-        segment_descriptions = self.filter_segment_descriptions(metadata_file_path)
-        
-        # Normalize the source DICOM images
-        dicom_datasets = self._normalize_source_images(dicom_series_path)
-
-        # Create the DICOM SEG file
-        seg_instance_uid = hd.UID()
-        seg = hd.seg.Segmentation(
-            source_images=dicom_datasets,
-            pixel_array=pixel_array,
-            segmentation_type=hd.seg.SegmentationTypeValues.BINARY,
-            segment_descriptions=segment_descriptions,
+    # Parse the source series headers once and share them across all steps
+    def _load_source_series(self, dicom_series_path) -> SourceSeries:
+        if self.header_cache is not None:
+            return self.header_cache.load(dicom_series_path)
+        return SourceSeries.from_sources(dicom_series_path)
+
+
+    # Validate a label map aligned with the source series, probability maps have no label index
+    def _validate_labels(self, pixel_array, segment_descriptions) -> Optional[LabelIndex]:
+        if pixel_array.dtype.kind == 'f':
+            return None
+        return validate_label_map(pixel_array, [desc.SegmentNumber for desc in segment_descriptions])
+
+    # Attributes of the new SEG instance
+    def _instance_attributes(self, dicom_datasets):
+        return dict(
             series_instance_uid=dicom_datasets[0].SeriesInstanceUID,
             series_number=dicom_datasets[0].SeriesNumber,
-            sop_instance_uid=seg_instance_uid,
+            sop_instance_uid=hd.UID(),
             instance_number=1,
             manufacturer="",
             manufacturer_model_name="",
             software_versions="",
             device_serial_number="",
-            omit_empty_frames=True,
         )
 
-        # Save the DICOM SEG file
-        os.makedirs(output_path, exist_ok=True)
-        output_file_path = os.path.join(output_path, f"SR{dicom_datasets[0].SeriesNumber}"+"_segmentation_temp.dcm")
+    # Build the DICOM SEG dataset, compressed frames are encoded in parallel threads
+    def _create_segmentation(self, pixel_array, dicom_datasets, segment_descriptions,
+                             segmentation_type, transfer_syntax, workers, label_index=None, previous=None):
+        from seg_writer.frames import create_sparse_segmentation
+
+        frame_transfer_syntax = frame_transfer_syntax_for(transfer_syntax)
+        encoder = ThreadPoolExecutor(workers) if frame_transfer_syntax.is_compressed else None
+        instance_attributes = self._instance_attributes(dicom_datasets)
+        try:
+            label_map = pixel_array.ndim == 3 and pixel_array.dtype.kind in 'biu'
+            if previous is not None and not label_map:
+                raise ValueError("Only label maps can be updated, probability maps have to be converted again.")
+            if previous is not None:
+                from seg_writer.update import create_updated_segmentation
+
+                # Updates keep the items and frames of unchanged segments encoded, see `_single_stages`
+                seg = create_updated_segmentation(
+                    previous,
+                    dicom_datasets,
+                    pixel_array,
+                    segment_descriptions,
+                    frame_transfer_syntax,
+                    executor=encoder,
+                    label_index=label_index,
+                    **instance_attributes,
+                )
+            elif label_map:
+                # Label maps: only non-empty (segment, slice) frames are generated
+                seg = create_sparse_segmentation(
+                    dicom_datasets,
+                    pixel_array,
+                    segment_descriptions,
+                    segmentation_type,
+                    frame_transfer_syntax,
+                    executor=encoder,
+                    label_index=label_index,
+                    **instance_attributes,
+                )
+            else:
+                # Probability maps
+                seg = hd.seg.Segmentation(
+                    source_images=dicom_datasets,
+                    pixel_array=pixel_array,
+                    segmentation_type=segmentation_type,
+                    segment_descriptions=segment_descriptions,
+                    transfer_syntax_uid=frame_transfer_syntax,
+                    omit_empty_frames=True,
+                    workers=encoder or 0,
+                    **instance_attributes,
+                )
+        finally:
+            if encoder is not None:
+                encoder.shutdown()
+        return seg
+
+    # Encode the DICOM SEG file to a path or file-like object, deflated in a single pass unless frames are compressed
+    def _encode_segmentation(self, seg, target, transfer_syntax, compression_level):
+        if transfer_syntax == pydicom.uid.DeflatedExplicitVRLittleEndian:
+            return write_deflated(seg, target, compression_level)
+        return write_dicom(seg, target)
+
+    # Encode into an open temporary file, the caller moves it into place so the encoders need no temporary file of their own
+    def _encode_to_file(self, encode, temp_path):
+        with open(temp_path, "wb") as file:
+            encode(file)
+        return temp_path
+
+    # Verify an encoded DICOM SEG file and move it into place, a SEG failing verification is never moved
+    def _commit_segmentation(self, temp_path, output_file_path, verify) -> str:
+        verify(temp_path)
+        os.replace(temp_path, output_file_path)
+        return output_file_path
+
+    # Returns the check of a written SEG in the writer's verification mode, see `verify_segmentation`
+    def _verifier(self, transfer_syntax, source_images, seg=None, volume=None, labels=None, label_index=None):
+        return lambda target: verify_segmentation(target, self.verify, transfer_syntax, source_images, seg, volume,
+                                                  labels, label_index)
+
+    # Name of the SEG file in the output directory, files of a split segmentation are numbered by instance
+    def _output_file_path(self, output_path, series_number, instance_number=None) -> str:
+        if instance_number is not None:
+            return os.path.join(output_path, f"SR{series_number}_segmentation_{instance_number}.dcm")
+        return os.path.join(output_path, f"SR{series_number}"+"_segmentation.dcm")
+
+    # Output type and transfer syntax requested by the caller
+    def _output_options(self, segmentation_type, encoding):
+        return segmentation_type_for(segmentation_type), transfer_syntax_for(encoding)
+
+    # A SEG being updated, with the output type and transfer syntax it keeps
+    def _load_previous(self, previous_file_path, segmentation_type, encoding):
+        if previous_file_path is None:
+            return (None,) + self._output_options(segmentation_type, encoding)
+        from seg_writer.update import PreviousSegmentation
+
+        previous = PreviousSegmentation.from_file(previous_file_path)
+        return previous, previous.segmentation_type, previous.transfer_syntax
+
+    # Encode and write stages shared by all conversions, partial output is removed if they do not complete
+    def _output_stages(self, encode, output_path, series_number, verify):
+        if output_path is None or is_file_like(output_path):
+            return (yield from self._memory_output_stages(encode, output_path, verify))
+
+        output_file_path = self._output_file_path(output_path, series_number)
+        temp_path = f"{output_file_path}.{uuid.uuid4().hex}.partial"
+
+        def encode_file():
+            os.makedirs(output_path, exist_ok=True)
+            return self._encode_to_file(encode, temp_path)
+
+        try:
+            yield ENCODE, encode_file
+            return (yield WRITE, lambda: self._commit_segmentation(temp_path, output_file_path, verify))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    # Encode into memory, then write the SEG to a file-like object or return it as a memoryview
+    def _memory_output_stages(self, encode, output, verify):
+        buffer = io.BytesIO()
+        yield ENCODE, lambda: encode(buffer)
+
+        def write():
+            verify(buffer)
+            if output is None:
+                return buffer.getbuffer()
+            output.write(buffer.getbuffer())
+            return output
+
+        return (yield WRITE, write)
+
+    # Build, encode and write a single SEG instance, or the update of a previous one
+    def _single_stages(self, pixel_array, label_index, source_series, segment_descriptions, segmentation_type,
+                       transfer_syntax, compression_level, workers, output_path, previous):
+        # Create the DICOM SEG dataset
+        seg = yield BUILD, lambda: self._create_segmentation(pixel_array, source_series.datasets, segment_descriptions,
+                                                             segmentation_type, transfer_syntax, workers, label_index,
+                                                             previous)
+
+        if previous is not None:
+            # An update's dataset holds no frames, like a streamed SEG it is checked from its file
+            return (yield from self._output_stages(
+                lambda target: seg.write(target, transfer_syntax, compression_level),
+                output_path, seg.dataset.SeriesNumber,
+                self._verifier(transfer_syntax, source_series.datasets, volume=pixel_array, label_index=label_index),
+            ))
+
+        # Save the DICOM SEG file and verify it
+        return (yield from self._output_stages(
+            lambda target: self._encode_segmentation(seg, target, transfer_syntax, compression_level),
+            output_path, seg.SeriesNumber,
+            self._verifier(transfer_syntax, source_series.datasets, seg, pixel_array, label_index=label_index),
+        ))
+
+    # Build, encode and write several SEG instances of one series, returning their manifest
+    def _split_stages(self, pixel_array, label_index, source_series, segment_descriptions, segmentation_type,
+                      transfer_syntax, compression_level, workers, output_path, max_frames, segment_groups):
+
+        def build():
+            from seg_writer.split import create_split_segmentations, plan_instances
+
+            if label_index is None:
+                raise ValueError("Only label maps can be split into several SEG instances.")
+            instances = plan_instances(label_index, [desc.SegmentNumber for desc in segment_descriptions],
+                                       max_frames, segment_groups)
+            frame_transfer_syntax = frame_transfer_syntax_for(transfer_syntax)
+            encoder = ThreadPoolExecutor(workers) if frame_transfer_syntax.is_compressed else None
+            try:
+                segs = create_split_segmentations(
+                    source_series.datasets,
+                    pixel_array,
+                    segment_descriptions,
+                    segmentation_type,
+                    frame_transfer_syntax,
+                    instances,
+                    label_index,
+                    workers=workers,
+                    executor=encoder,
+                    **self._instance_attributes(source_series.datasets),
+                )
+            finally:
+                if encoder is not None:
+                    encoder.shutdown()
+            return instances, segs
+
+        instances, segs = yield BUILD, build
+
+        in_memory = output_path is None
+        if in_memory:
+            targets = [io.BytesIO() for _ in segs]
+        else:
+            output_file_paths = [self._output_file_path(output_path, seg.SeriesNumber, seg.InstanceNumber) for seg in segs]
+            targets = [f"{path}.{uuid.uuid4().hex}.partial" for path in output_file_paths]
+
+        def encode_instance(seg, target):
+            if in_memory:
+                return self._encode_segmentation(seg, target, transfer_syntax, compression_level)
+            return self._encode_to_file(
+                lambda file: self._encode_segmentation(seg, file, transfer_syntax, compression_level), target)
+
+        # Instances are encoded in parallel threads
+        def encode():
+            if not in_memory:
+                os.makedirs(output_path, exist_ok=True)
+            with ThreadPoolExecutor(workers) as encoders:
+                list(encoders.map(encode_instance, segs, targets))
+
+        def write():
+            manifest = []
+            for index, (seg, labels, target) in enumerate(zip(segs, instances, targets)):
+                entry = {
+                    "instance_number": int(seg.InstanceNumber),
+                    "sop_instance_uid": str(seg.SOPInstanceUID),
+                    "frames": int(seg.NumberOfFrames),
+                    "segments": [
+                        {"segment_number": int(desc.SegmentNumber), "label": label, "segment_label": desc.SegmentLabel}
+                        for desc, label in zip(seg.SegmentSequence, labels)
+                    ],
+                }
+                verify = self._verifier(transfer_syntax, source_series.datasets, seg, pixel_array, labels, label_index)
+                if in_memory:
+                    verify(target)
+                    entry["data"] = target.getbuffer()
+                else:
+                    entry["path"] = self._commit_segmentation(target, output_file_paths[index], verify)
+                manifest.append(entry)
+            return manifest
+
+        try:
+            yield ENCODE, encode
+            return (yield WRITE, write)
+        finally:
+            if not in_memory:
+                for target in targets:
+                    if os.path.exists(target):
+                        os.remove(target)
+
+    # Splitting needs a label map held in memory and one output per instance
+    def _check_split_options(self, output_path, max_frames, segment_groups, slab_size=None):
+        if max_frames is None and segment_groups is None:
+            return False
+        if slab_size is not None:
+            raise ValueError("slab_size can not be combined with max_frames or segment_groups.")
+        if is_file_like(output_path):
+            raise ValueError("A split segmentation is written to a directory or returned in memory, not to a file-like object.")
+        return True
+
+    # Stages of `from_nifti`, run by `run_stages` or `run_stages_async`
+    def _nifti_stages(self, nifti_file_path, dicom_series_path, metadata_file_path, output_path, compression_level,
+                      encoding, segmentation_type, workers, slab_size, max_frames=None, segment_groups=None, resample=None):
+        segmentation_type_for(segmentation_type)
+        split = self._check_split_options(output_path, max_frames, segment_groups, slab_size)
+        if slab_size is not None and resample is not None:
+            raise ValueError("slab_size can not be combined with resample, slabs are read on the source series grid.")
+        if slab_size is not None:
+            return self._stream_stages(nifti_file_path, dicom_series_path, metadata_file_path, output_path,
+                                       compression_level, encoding, segmentation_type, workers, slab_size)
+        return self._loaded_nifti_stages(nifti_file_path, dicom_series_path, metadata_file_path, output_path,
+                                         compression_level, encoding, segmentation_type, workers,
+                                         (max_frames, segment_groups) if split else None, resample=resample)
+
+    def _loaded_nifti_stages(self, nifti_file_path, dicom_series_path, metadata_file_path, output_path,
+                             compression_level, encoding, segmentation_type, workers, split=None, previous_file_path=None,
+                             resample=None):
+
+        def load():
+            # An update reads the previous SEG and keeps its type and transfer syntax
+            previous, seg_type, transfer_syntax = self._load_previous(previous_file_path, segmentation_type, encoding)
+            # Load the NIfTI file once to get the pixel data
+            segmentation = self._load_nifti_file(nifti_file_path, label_map=seg_type == hd.seg.SegmentationTypeValues.BINARY)
+            # Parse the source DICOM headers once
+            source_series = self._load_source_series(dicom_series_path)
+            # Read the metadata and filter the segment descriptions
+            segment_descriptions = self.filter_segment_descriptions(metadata_file_path)
+            return previous, seg_type, transfer_syntax, segmentation, source_series, segment_descriptions
+
+        previous, seg_type, transfer_syntax, segmentation, source_series, segment_descriptions = yield LOAD, load
+
+        # Map a label map of another grid onto the source series, grids differing in axis order only are just reoriented
+        resampled = None
+        if resample is not None:
+            resampled = yield RESAMPLE, lambda: resample_pixel_array(segmentation, source_series, resample, workers)
+
+        def validate():
+            if segmentation.volume.dtype.kind == 'f':
+                # Probability maps for FRACTIONAL segmentations
+                check_probability_map(segmentation)
+            else:
+                # Check overlap
+                check_for_overlap(segmentation=segmentation)
+
+            # Match the shape of segmentation and source dicom files
+            pixel_array = resampled if resampled is not None else reorient_pixel_array(segmentation,source_series)
+
+            # Find the present labels in one pass, checking them against the metadata
+            return pixel_array, self._validate_labels(pixel_array, segment_descriptions)
+
+        pixel_array, label_index = yield VALIDATE, validate
+
+        if split is not None:
+            return (yield from self._split_stages(pixel_array, label_index, source_series, segment_descriptions, seg_type,
+                                                  transfer_syntax, compression_level, workers, output_path, *split))
+
+        return (yield from self._single_stages(pixel_array, label_index, source_series, segment_descriptions, seg_type,
+                                               transfer_syntax, compression_level, workers, output_path, previous))
+
+    # Stages of a NIfTI label map converted slab by slab, without loading the volume or all frames
+    def _stream_stages(self, nifti_file_path, dicom_series_path, metadata_file_path, output_path, compression_level,
+                       encoding, segmentation_type, workers, slab_size):
+
+        def load():
+            seg_type, transfer_syntax = self._output_options(segmentation_type, encoding)
+            # Open the NIfTI file without reading it
+            segmentation = LoadedSegmentation.open(nifti_file_path)
+            source_series = self._load_source_series(dicom_series_path)
+            segment_descriptions = self.filter_segment_descriptions(metadata_file_path)
+            return seg_type, transfer_syntax, segmentation, source_series, segment_descriptions
+
+        seg_type, transfer_syntax, segmentation, source_series, segment_descriptions = yield LOAD, load
+
+        # Slabs are read, validated and their frames built and encoded in a single pass
+        def encode(target):
+            from seg_writer.streaming import write_streamed_segmentation
+
+            encoder = ThreadPoolExecutor(workers) if frame_transfer_syntax_for(transfer_syntax).is_compressed else None
+            try:
+                write_streamed_segmentation(
+                    segmentation,
+                    source_series,
+                    segment_descriptions,
+                    target,
+                    seg_type,
+                    transfer_syntax,
+                    compression_level,
+                    slab_size=slab_size,
+                    executor=encoder,
+                    **self._instance_attributes(source_series.datasets),
+                )
+            finally:
+                if encoder is not None:
+                    encoder.shutdown()
+            return target
+
+        # Only a full verification loads the whole label map, to compare it with the written frames
+        verify = self._verifier(transfer_syntax, source_series.datasets,
+                                volume=lambda: reorient_pixel_array(nifti_file_path, source_series))
+        return (yield from self._output_stages(encode, output_path, source_series.datasets[0].SeriesNumber, verify))
+
+    # Stages of `from_array`, run by `run_stages` or `run_stages_async`
+    def _array_stages(self, pixel_array, dicom_series_path, metadata_file_path, output_path, compression_level,
+                      encoding, segmentation_type, workers, max_frames=None, segment_groups=None):
+        segmentation_type_for(segmentation_type)
+        split = self._check_split_options(output_path, max_frames, segment_groups)
+        return self._loaded_array_stages(pixel_array, dicom_series_path, metadata_file_path, output_path,
+                                         compression_level, encoding, segmentation_type, workers,
+                                         (max_frames, segment_groups) if split else None)
+
+    def _loaded_array_stages(self, pixel_array, dicom_series_path, metadata_file_path, output_path,
+                             compression_level, encoding, segmentation_type, workers, split=None, previous_file_path=None):
+
+        def load():
+            # An update reads the previous SEG and keeps its type and transfer syntax
+            previous, seg_type, transfer_syntax = self._load_previous(previous_file_path, segmentation_type, encoding)
+            # Parse the source DICOM headers once
+            source_series = self._load_source_series(dicom_series_path)
+            # Make segmentation descriptions
+            segment_descriptions = self.filter_segment_descriptions(metadata_file_path)
+            return previous, seg_type, transfer_syntax, source_series, segment_descriptions
+
+        previous, seg_type, transfer_syntax, source_series, segment_descriptions = yield LOAD, load
+
+        def validate():
+            if pixel_array.dtype.kind == 'f':
+                # Probability maps for FRACTIONAL segmentations
+                check_probability_map(pixel_array)
+            else:
+                # Check overlap
+                check_for_overlap(segmentation=pixel_array)
+
+            # Match the shape of segmentation and source dicom files
+            matched = match_shape_segmentation_and_dicom(pixel_array,dicom_series_path,source_series.datasets)
+
+            # Find the present labels in one pass, checking them against the metadata
+            return matched, self._validate_labels(matched, segment_descriptions)
+
+        matched, label_index = yield VALIDATE, validate
 
-        metadata = self.read_metadata(metadata_file_path)
-        segment_attributes = [item for sublist in metadata['segmentAttributes'] for item in sublist]
-        seg = add_color(segment_attributes,seg)
+        if split is not None:
+            return (yield from self._split_stages(matched, label_index, source_series, segment_descriptions, seg_type,
+                                                  transfer_syntax, compression_level, workers, output_path, *split))
 
-        seg.save_as(str(output_file_path))
+        return (yield from self._single_stages(matched, label_index, source_series, segment_descriptions, seg_type,
+                                               transfer_syntax, compression_level, workers, output_path, previous))
 
-        # Call deflated method for compression
-        compressed_file = os.path.join(output_path, f"SR{dicom_datasets[0].SeriesNumber}"+"_segmentation.dcm")
-        compress_dicom(output_file_path,compressed_file)
-        os.remove(output_file_path)
+    def from_nifti(self,nifti_file_path, dicom_series_path, metadata_file_path, output_path, compression_level=zlib.Z_DEFAULT_COMPRESSION,
+                   encoding="deflate", segmentation_type="BINARY", workers=None, slab_size=None, progress=None, metrics=None,
+                   max_frames=None, segment_groups=None, resample=None):
 
-        # Read the generated file for final confirmation
-        reading_back(compressed_file)
+        compressed_file = run_stages(self._nifti_stages(nifti_file_path, dicom_series_path, metadata_file_path, output_path,
+                                                        compression_level, encoding, segmentation_type, workers, slab_size,
+                                                        max_frames, segment_groups, resample),
+                                     progress, metrics)
 
         # Explicitly manage memory
-        del pixel_array
-        del dicom_datasets
-        del segment_descriptions
         gc.collect()
 
-        metadata = self.read_metadata(metadata_file_path)
-        segment_attributes = [item for sublist in metadata['segmentAttributes'] for item in sublist]
-
         return compressed_file
 
-    def from_array(self, pixel_array, dicom_series_path, metadata_file_path, output_path):
-        
-        # Check overlap
-        check_for_overlap(segmentation=pixel_array)
+    def from_array(self, pixel_array, dicom_series_path, metadata_file_path, output_path, compression_level=zlib.Z_DEFAULT_COMPRESSION,
+                   encoding="deflate", segmentation_type="BINARY", workers=None, progress=None, metrics=None,
+                   max_frames=None, segment_groups=None):
 
-        # Iterate on segmentation to check is lables present and if no lables presents return error and if found one return list of uniqe lables
-        get_nifti_labels(pixel_array)
+        compressed_file = run_stages(self._array_stages(pixel_array, dicom_series_path, metadata_file_path, output_path,
+                                                        compression_level, encoding, segmentation_type, workers,
+                                                        max_frames, segment_groups),
+                                     progress, metrics)
 
-        # Normalize the source DICOM images
-        dicom_datasets = self._normalize_source_images(dicom_series_path)
+        # Explicitly manage memory
+        gc.collect()
+        return compressed_file
 
-        # Match the shape of segmentation and source dicom files
-        pixel_array = match_shape_segmentation_and_dicom(pixel_array,dicom_series_path,dicom_datasets)
+    # Update stages reuse the conversion stages with the previous SEG read in the load stage
+    def _update_nifti_stages(self, seg_file_path, nifti_file_path, dicom_series_path, metadata_file_path, output_path,
+                             compression_level, workers, resample=None):
+        return self._loaded_nifti_stages(nifti_file_path, dicom_series_path, metadata_file_path, output_path,
+                                         compression_level, None, None, workers, previous_file_path=seg_file_path,
+                                         resample=resample)
 
-        # Make segmentation descriptions
-        segment_descriptions = self.filter_segment_descriptions(metadata_file_path)
+    def _update_array_stages(self, seg_file_path, pixel_array, dicom_series_path, metadata_file_path, output_path,
+                             compression_level, workers):
+        return self._loaded_array_stages(pixel_array, dicom_series_path, metadata_file_path, output_path,
+                                         compression_level, None, None, workers, previous_file_path=seg_file_path)
 
-        # Create the DICOM SEG file
-        seg_instance_uid = hd.UID()
-        seg = hd.seg.Segmentation(
-            source_images=dicom_datasets,
-            pixel_array=pixel_array,
-            segmentation_type=hd.seg.SegmentationTypeValues.BINARY,
-            segment_descriptions=segment_descriptions,
-            series_instance_uid=dicom_datasets[0].SeriesInstanceUID,
-            series_number=dicom_datasets[0].SeriesNumber,
-            sop_instance_uid=seg_instance_uid,
-            instance_number=1,
-            manufacturer="",
-            manufacturer_model_name="",
-            software_versions="",
-            device_serial_number="",
-            omit_empty_frames=True,
-        )
+    def update_from_nifti(self, seg_file_path, nifti_file_path, dicom_series_path, metadata_file_path, output_path,
+                          compression_level=zlib.Z_DEFAULT_COMPRESSION, workers=None, progress=None, metrics=None,
+                          resample=None):
 
-        # Save the DICOM SEG file
-        os.makedirs(output_path, exist_ok=True)
-        output_file_path = os.path.join(output_path, f"SR{dicom_datasets[0].SeriesNumber}"+"_segmentation_temp.dcm")
+        compressed_file = run_stages(self._update_nifti_stages(seg_file_path, nifti_file_path, dicom_series_path,
+                                                               metadata_file_path, output_path, compression_level, workers,
+                                                               resample),
+                                     progress, metrics)
 
-        metadata = self.read_metadata(metadata_file_path)
-        segment_attributes = [item for sublist in metadata['segmentAttributes'] for item in sublist]
-        seg = add_color(segment_attributes,seg)
-        
-        seg.save_as(str(output_file_path))
+        # Explicitly manage memory
+        gc.collect()
+        return compressed_file
 
-        # Call deflated method for compression
-        compressed_file = os.path.join(output_path, f"SR{dicom_datasets[0].SeriesNumber}"+"_segmentation.dcm")
-        compress_dicom(output_file_path,compressed_file)
-        os.remove(output_file_path)
+    def update_from_array(self, seg_file_path, pixel_array, dicom_series_path, metadata_file_path, output_path,
+                          compression_level=zlib.Z_DEFAULT_COMPRESSION, workers=None, progress=None, metrics=None):
 
-        # Read the generated file for final confirmation
-        reading_back(compressed_file)
+        compressed_file = run_stages(self._update_array_stages(seg_file_path, pixel_array, dicom_series_path,
+                                                               metadata_file_path, output_path, compression_level, workers),
+                                     progress, metrics)
 
         # Explicitly manage memory
-        del pixel_array
-        del dicom_datasets
-        del segment_descriptions
         gc.collect()
-        return compressed_file
\ No newline at end of file
+        return compressed_file
@@ -1,17 +1,14 @@
 __version__ = "0.1.5"
 
-import pydicom
-import SimpleITK as sitk
-import highdicom as hd
-from typing import List, Union
-from os import PathLike
-import json
-from highdicom import AlgorithmIdentificationSequence
-from pydicom.sr.codedict import codes
-import os
-from seg_writer.utils import *
-from concurrent.futures import ThreadPoolExecutor
-import gc
-import numpy as np
-from pathlib import Path
-import os
+import importlib
+
+
+# Names of seg_writer.utils stay available as seg_writer.<name>, imported on first use
+def __getattr__(name):
+    if name.startswith("__"):
+        raise AttributeError(f"module 'seg_writer' has no attribute {name!r}")
+    utils = importlib.import_module("seg_writer.utils")
+    try:
+        return getattr(utils, name)
+    except AttributeError:
+        raise AttributeError(f"module 'seg_writer' has no attribute {name!r}") from None
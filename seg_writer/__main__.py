@@ -0,0 +1,52 @@
+import argparse
+import os
+import sys
+
+from seg_writer.batch import run_batch
+
+
+def _print_result(result):
+    line = f"[{result['status']}] {result['nifti']} ({result['seconds']:.1f}s, attempts: {result['attempts']})"
+    if result["error"]:
+        line += f" {result['error']}"
+    print(line, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="seg_writer", description="Create DICOM SEG files from NIfTI files.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    batch = subparsers.add_parser("batch", help="convert every row of a manifest CSV")
+    batch.add_argument("manifest", help="CSV with the columns nifti,dicom_series,metadata,output")
+    batch.add_argument("-j", "--workers", type=int, default=None, help="number of worker processes (default: CPU count)")
+    batch.add_argument("--memory-limit-mb", type=int, default=None, help="address space limit per worker in MB")
+    batch.add_argument("--slab-size", type=int, default=None, help="read each NIfTI file in slabs of this many slices to bound memory")
+    batch.add_argument("--retries", type=int, default=1, help="retries per failed job before it is skipped")
+    batch.add_argument("--header-cache", default=None, help="directory caching parsed source series headers across jobs")
+    batch.add_argument("--verify", choices=("off", "fast", "full"), default="fast", help="check of every written SEG (default: fast)")
+    batch.add_argument("--resample", choices=("nearest", "linear"), default=None,
+                       help="resample label maps of another grid onto the source series")
+    batch.add_argument("--summary", default=None, help="path of the per-job summary CSV (default: <manifest>_summary.csv)")
+
+    args = parser.parse_args(argv)
+
+    summary_path = args.summary or os.path.splitext(args.manifest)[0] + "_summary.csv"
+    results = run_batch(
+        args.manifest,
+        workers=args.workers,
+        memory_limit_mb=args.memory_limit_mb,
+        retries=args.retries,
+        slab_size=args.slab_size,
+        header_cache_dir=args.header_cache,
+        verify=args.verify,
+        resample=args.resample,
+        summary_path=summary_path,
+        on_result=_print_result,
+    )
+    failed = sum(result["status"] != "ok" for result in results)
+    print(f"{len(results) - failed}/{len(results)} studies converted, summary written to {summary_path}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from seg_writer.catalog import load_catalog
+
+# Columns expected in a batch manifest
+MANIFEST_COLUMNS = ("nifti", "dicom_series", "metadata", "output")
+SUMMARY_COLUMNS = MANIFEST_COLUMNS + ("status", "attempts", "seconds", "output_file", "error")
+
+
+# Read a manifest CSV (with header) into a list of jobs, relative paths are taken from the manifest directory
+def read_manifest(manifest_path):
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, newline='') as file:
+        reader = csv.DictReader(file)
+        missing = [c for c in MANIFEST_COLUMNS if c not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(f"Manifest {manifest_path} is missing columns: {', '.join(missing)}")
+        return [{column: os.path.join(base_dir, row[column].strip()) for column in MANIFEST_COLUMNS} for row in reader]
+
+
+# Cap the address space of a worker process so one study can not exhaust the machine
+def _limit_memory(memory_limit_mb):
+    if not memory_limit_mb:
+        return
+    import resource
+    limit = int(memory_limit_mb) * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+# Result of a failed attempt, exceptions are kept as text because not all of them can be pickled
+def _failure(start, ex):
+    return {"status": "failed", "seconds": time.perf_counter() - start, "output_file": "",
+            "error": f"{type(ex).__name__}: {ex}"}
+
+
+# Convert a single study inside a worker process
+def _run_job(job, slab_size=None, header_cache_dir=None, verify="fast", resample=None):
+    start = time.perf_counter()
+    try:
+        # Imported here so a worker failing to import (e.g. under its memory limit) only fails this job
+        from seg_writer.Writer import Writer
+        from seg_writer.headers import HeaderCache
+
+        header_cache = HeaderCache(directory=header_cache_dir) if header_cache_dir else None
+        writer = Writer(header_cache=header_cache, verify=verify)
+        output_file = writer.from_nifti(job["nifti"], job["dicom_series"], job["metadata"], job["output"],
+                                        slab_size=slab_size, resample=resample)
+    except Exception as ex:
+        return _failure(start, ex)
+    return {"status": "ok", "seconds": time.perf_counter() - start, "output_file": output_file, "error": ""}
+
+
+# Convert a single study in a pool of its own, so a crashing worker can only be blamed on this study
+def _run_isolated(job, memory_limit_mb, job_args):
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=1, initializer=_limit_memory, initargs=(memory_limit_mb,)) as executor:
+        try:
+            return executor.submit(_run_job, job, *job_args).result(), False
+        except BrokenProcessPool:
+            return {"status": "failed", "seconds": time.perf_counter() - start, "output_file": "",
+                    "error": "Worker process terminated abruptly"}, True
+        except Exception as ex:
+            # e.g. a result that can not be pickled
+            return _failure(start, ex), False
+
+
+def run_batch(jobs, workers=None, memory_limit_mb=None, retries=1, summary_path=None, on_result=None, slab_size=None,
+              header_cache_dir=None, verify="fast", resample=None):
+    """Convert many studies with `Writer.from_nifti` across a process pool.
+
+    `jobs` is a manifest path or a list of dicts with the keys in
+    `MANIFEST_COLUMNS`. A failing job is retried up to `retries` times and
+    then skipped; it never aborts the run. `memory_limit_mb` caps the
+    address space of every worker (Unix only) and `slab_size` makes every
+    job stream its NIfTI file in slabs of that many slices (see
+    `Writer.from_nifti`). With `header_cache_dir` the workers share a
+    `HeaderCache` on disk, so a series used by several jobs is parsed once.
+    `verify` is the verification mode of every written SEG (see `Writer`)
+    and `resample` the interpolation mapping label maps of another grid onto
+    their source series (see `Writer.from_nifti`). A worker that dies takes
+    down the whole pool; the jobs it interrupted are run again in a pool of
+    their own each, without counting the attempt, and only a job crashing
+    alone fails. Returns one result dict per job, in manifest order, and
+    writes them as CSV to `summary_path` if given.
+    """
+    if isinstance(jobs, (str, os.PathLike)):
+        jobs = read_manifest(jobs)
+    if memory_limit_mb and os.name == 'nt':
+        raise ValueError("Per-job memory limits are only supported on Unix.")
+
+    # Catalogs loaded here are inherited by forked workers
+    for metadata_file_path in {job["metadata"] for job in jobs}:
+        try:
+            load_catalog(metadata_file_path)
+        except (OSError, ValueError, KeyError):
+            pass  # reported by the job itself
+
+    results = [dict(job, status="pending", attempts=0, seconds=0.0, output_file="", error="") for job in jobs]
+    job_args = (slab_size, header_cache_dir, verify, resample)
+    pending = list(range(len(results)))
+    crashed = set()
+
+    while pending:
+        retry = []
+
+        def finish(index, outcome):
+            result = results[index]
+            result["attempts"] += 1
+            result.update(outcome)
+            if result["status"] != "ok" and result["attempts"] <= retries:
+                retry.append(index)
+            elif on_result is not None:
+                on_result(result)
+
+        # Jobs that crashed a worker before are only run alone
+        isolated = [index for index in pending if index in crashed]
+        shared = [index for index in pending if index not in crashed]
+        if shared:
+            # A new pool is started per round so a crashed worker (e.g. killed for memory) can not block retries
+            with ProcessPoolExecutor(max_workers=workers, initializer=_limit_memory, initargs=(memory_limit_mb,)) as executor:
+                start = time.perf_counter()
+                futures = {executor.submit(_run_job, jobs[index], *job_args): index for index in shared}
+                for future in as_completed(futures):
+                    index = futures[future]
+                    try:
+                        outcome = future.result()
+                    except BrokenProcessPool:
+                        # Every job of the pool fails when one worker dies, not only the one that crashed it
+                        isolated.append(index)
+                        continue
+                    except Exception as ex:
+                        # Anything else raised by the worker fails this attempt only
+                        outcome = _failure(start, ex)
+                    finish(index, outcome)
+
+        if isolated:
+            with ThreadPoolExecutor(workers or os.cpu_count()) as runner:
+                outcomes = runner.map(lambda index: _run_isolated(jobs[index], memory_limit_mb, job_args), isolated)
+                for index, (outcome, crashed_alone) in zip(isolated, outcomes):
+                    if crashed_alone:
+                        crashed.add(index)
+                    finish(index, outcome)
+        pending = sorted(retry)
+
+    if summary_path is not None:
+        write_summary(results, summary_path)
+    return results
+
+
+# Write per-job results as CSV
+def write_summary(results, summary_path):
+    with open(summary_path, "w", newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=SUMMARY_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        for result in results:
+            writer.writerow(dict(result, seconds=f"{result['seconds']:.3f}"))
@@ -0,0 +1,122 @@
+import json
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+from seg_writer.lazy import LazyModule
+
+hd = LazyModule("highdicom")
+# pydicom's code dictionary is large, it is only loaded once descriptions are built
+codedict = LazyModule("pydicom.sr.codedict")
+
+# Number of metadata files kept in memory per process
+CATALOG_CACHE_SIZE = 16
+
+_catalogs = OrderedDict()
+_catalogs_lock = threading.Lock()
+
+
+# Recommended display color of a metadata entry as DICOM CIELab values
+def display_color_value(desc):
+    """Return the RecommendedDisplayCIELabValue of a metadata entry, converting RGB colors if needed."""
+    if "RecommendedDisplayCIELabValue" in desc:
+        return [int(v) for v in desc["RecommendedDisplayCIELabValue"]]
+    for key in ("recommendedDisplayRGBValue", "RecommendedDisplayRGBValue"):
+        if key in desc:
+            return list(hd.color.CIELabColor.from_rgb(*(int(v) for v in desc[key])).value)
+    return None
+
+
+# Build the highdicom segment description of one metadata entry
+def _segment_description(desc):
+    category = hd.sr.CodedConcept(
+        value=desc['SegmentedPropertyCategoryCodeSequence']['CodeValue'],
+        scheme_designator=desc['SegmentedPropertyCategoryCodeSequence']['CodingSchemeDesignator'],
+        meaning=desc['SegmentedPropertyCategoryCodeSequence']['CodeMeaning']
+    )
+    type_code = hd.sr.CodedConcept(
+        value=desc['SegmentedPropertyTypeCodeSequence']['CodeValue'],
+        scheme_designator=desc['SegmentedPropertyTypeCodeSequence']['CodingSchemeDesignator'],
+        meaning=desc['SegmentedPropertyTypeCodeSequence']['CodeMeaning']
+    )
+    segment_description = hd.seg.SegmentDescription(
+        segment_number=desc['labelID'],
+        segment_label=desc['SegmentLabel'],
+        segmented_property_category=category,
+        segmented_property_type=type_code,
+        algorithm_type=hd.seg.SegmentAlgorithmTypeValues.AUTOMATIC.value,
+        algorithm_identification=hd.AlgorithmIdentificationSequence(
+            name='AI',
+            version='',
+            family=codedict.codes.cid7162.ArtificialIntelligence
+        )
+    )
+    color = display_color_value(desc)
+    if color is not None:
+        segment_description.RecommendedDisplayCIELabValue = color
+    return segment_description
+
+
+class SegmentCatalog:
+    """Segment metadata and prebuilt segment descriptions of one metadata file.
+
+    Catalogs are shared between conversions, so `metadata` should not be
+    modified by callers. Descriptions are built once and handed out as
+    copies, as every SEG built from them takes them in as they are.
+    """
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self.segment_attributes = [item for sublist in metadata['segmentAttributes'] for item in sublist]
+        # Pickled once, unpickling a fresh copy is faster than deep-copying or building the coded concepts again
+        self._descriptions = OrderedDict(
+            (int(desc['labelID']), pickle.dumps(_segment_description(desc), protocol=pickle.HIGHEST_PROTOCOL))
+            for desc in self.segment_attributes
+        )
+
+    @classmethod
+    def from_file(cls, metadata_file_path):
+        with open(metadata_file_path, 'r') as file:
+            return cls(json.load(file))
+
+    @property
+    def labels(self):
+        return list(self._descriptions)
+
+    def descriptions(self, labels=None):
+        """Return copies of the segment descriptions of all segments, or only of `labels` in the given order."""
+        if labels is None:
+            return [pickle.loads(description) for description in self._descriptions.values()]
+        missing = [int(label) for label in labels if int(label) not in self._descriptions]
+        if missing:
+            raise ValueError(f"Labels {missing} are not described in the segmentation metadata.")
+        return [pickle.loads(self._descriptions[int(label)]) for label in labels]
+
+
+# Load a metadata file once per process, reloading it when the file changes
+def load_catalog(metadata_file_path):
+    """Return the `SegmentCatalog` of a metadata file from an LRU cache keyed by path and mtime."""
+    key = os.path.abspath(metadata_file_path)
+    stat = os.stat(key)
+    version = (stat.st_mtime_ns, stat.st_size)
+
+    with _catalogs_lock:
+        entry = _catalogs.get(key)
+        if entry is not None and entry[0] == version:
+            _catalogs.move_to_end(key)
+            return entry[1]
+
+    catalog = SegmentCatalog.from_file(key)
+
+    with _catalogs_lock:
+        _catalogs[key] = (version, catalog)
+        _catalogs.move_to_end(key)
+        while len(_catalogs) > CATALOG_CACHE_SIZE:
+            _catalogs.popitem(last=False)
+    return catalog
+
+
+def clear_catalog_cache():
+    with _catalogs_lock:
+        _catalogs.clear()
@@ -0,0 +1,292 @@
+from concurrent.futures import Future
+
+import numpy as np
+import highdicom as hd
+from highdicom.frame import encode_frame
+from highdicom.spatial import VOLUME_INDEX_CONVENTION, get_normal_vector, get_volume_positions
+from pydicom.dataelem import DataElement
+from pydicom.dataset import Dataset
+from pydicom.encaps import encapsulate
+from pydicom.valuerep import format_number_as_ds
+
+from seg_writer.hashes import SegmentHasher, set_segment_hashes
+from seg_writer.labels import LabelIndex, SLICE, ROW_MIN, ROW_MAX, COLUMN_MIN, COLUMN_MAX
+
+# Tags replaced in every per-frame functional groups item
+_DERIVATION_IMAGE_SEQUENCE = 0x00089124
+_SOURCE_IMAGE_SEQUENCE = 0x00082112
+_REFERENCED_SOP_CLASS_UID = 0x00081150
+_REFERENCED_SOP_INSTANCE_UID = 0x00081155
+_FRAME_CONTENT_SEQUENCE = 0x00209111
+_DIMENSION_INDEX_VALUES = 0x00209157
+_PLANE_POSITION_SEQUENCE = 0x00209113
+_SEGMENT_IDENTIFICATION_SEQUENCE = 0x0062000A
+_REFERENCED_SEGMENT_NUMBER = 0x0062000B
+
+
+# Order in which highdicom arranges planes of a series (ascending along its normal)
+def plane_order(source_images):
+    normal = get_normal_vector(source_images[0].ImageOrientationPatient, index_convention=VOLUME_INDEX_CONVENTION)
+    positions = np.array([ds.ImagePositionPatient for ds in source_images], dtype=np.float64)
+    return np.argsort(positions @ normal, kind='stable')
+
+
+# Copy a dataset, sharing every element except the ones given as {tag: (VR, value)}
+def _replace(template, replacements):
+    item = Dataset()
+    item.update(template)
+    for tag, (vr, value) in replacements.items():
+        item[tag] = DataElement(tag, vr, value)
+    return item
+
+
+# Per-frame functional groups item of one (segment, plane) frame, built from the template frame
+def frame_item(template, source_image, plane_position, dimension_index_values, segment_number):
+    derivation = template[_DERIVATION_IMAGE_SEQUENCE].value[0]
+    source = _replace(derivation[_SOURCE_IMAGE_SEQUENCE].value[0], {
+        _REFERENCED_SOP_CLASS_UID: ('UI', source_image.SOPClassUID),
+        _REFERENCED_SOP_INSTANCE_UID: ('UI', source_image.SOPInstanceUID),
+    })
+    content = _replace(template[_FRAME_CONTENT_SEQUENCE].value[0], {
+        _DIMENSION_INDEX_VALUES: ('UL', list(dimension_index_values)),
+    })
+    replacements = {
+        _DERIVATION_IMAGE_SEQUENCE: ('SQ', [_replace(derivation, {_SOURCE_IMAGE_SEQUENCE: ('SQ', [source])})]),
+        _FRAME_CONTENT_SEQUENCE: ('SQ', [content]),
+        _PLANE_POSITION_SEQUENCE: ('SQ', plane_position),
+    }
+    # With a single segment highdicom moves the segment identification to the shared functional groups
+    if _SEGMENT_IDENTIFICATION_SEQUENCE in template:
+        identification = _replace(template[_SEGMENT_IDENTIFICATION_SEQUENCE].value[0], {
+            _REFERENCED_SEGMENT_NUMBER: ('US', int(segment_number)),
+        })
+        replacements[_SEGMENT_IDENTIFICATION_SEQUENCE] = ('SQ', [identification])
+    return _replace(template, replacements)
+
+
+class BitPacker:
+    """Pack 1-bit frames back to back, as frames of BINARY segmentations share bytes."""
+
+    def __init__(self):
+        self._remainder = np.empty(0, dtype=np.uint8)
+
+    def add(self, frame):
+        """Add a frame, returning the bytes completed so far."""
+        pixels = np.ravel(frame).astype(np.uint8, copy=False)
+        if self._remainder.size:
+            pixels = np.concatenate([self._remainder, pixels])
+        complete = 8 * (pixels.size // 8)
+        self._remainder = pixels[complete:]
+        return np.packbits(pixels[:complete], bitorder='little').tobytes()
+
+    def flush(self):
+        """Return the last, partially filled byte."""
+        remainder = self._remainder
+        self._remainder = np.empty(0, dtype=np.uint8)
+        return np.packbits(remainder, bitorder='little').tobytes()
+
+
+# Pixels of one frame: the label inside its bounding box on that slice
+def segment_frame(volume, entry, label, frame_shape, value):
+    frame = np.zeros(frame_shape, dtype=np.uint8)
+    row_slice = slice(entry[ROW_MIN], entry[ROW_MAX])
+    column_slice = slice(entry[COLUMN_MIN], entry[COLUMN_MAX])
+    frame[row_slice, column_slice] = volume[entry[SLICE], row_slice, column_slice] == label
+    if value != 1:
+        frame *= value
+    return frame
+
+
+# Let highdicom build all attributes of a segmentation from a single plane holding one voxel
+def segmentation_template(source_images, frame_shape, segment_descriptions, segmentation_type,
+                          transfer_syntax_uid, template_slice=0, **kwargs):
+    """Return a one-frame `highdicom.seg.Segmentation` whose attributes hold for the whole series.
+
+    Its only per-frame functional groups item serves as template for
+    `frame_item`; PixelData and the frame count are replaced by the caller.
+    highdicom keeps `segment_descriptions` as they are, so they have to be
+    copies owned by this SEG, as `SegmentCatalog.descriptions` returns.
+    """
+    segment_numbers = [int(desc.SegmentNumber) for desc in segment_descriptions]
+    template_plane = np.zeros((1,) + tuple(frame_shape), dtype=np.min_scalar_type(max(segment_numbers)))
+    template_plane[0, 0, 0] = segment_numbers[0]
+    seg = hd.seg.Segmentation(
+        source_images=source_images,
+        pixel_array=template_plane,
+        segmentation_type=segmentation_type,
+        segment_descriptions=segment_descriptions,
+        transfer_syntax_uid=transfer_syntax_uid,
+        plane_positions=[hd.PlanePositionSequence(
+            hd.CoordinateSystemNames.PATIENT, source_images[template_slice].ImagePositionPatient
+        )],
+        omit_empty_frames=True,
+        **kwargs,
+    )
+
+    # highdicom derives the slice spacing from all planes it was given, here that is the whole series
+    pixel_measures = seg.SharedFunctionalGroupsSequence[0].PixelMeasuresSequence[0]
+    if 'SpacingBetweenSlices' not in source_images[0]:
+        slice_spacing, _ = get_volume_positions(
+            image_positions=[ds.ImagePositionPatient for ds in source_images],
+            image_orientation=source_images[0].ImageOrientationPatient,
+        )
+        if slice_spacing is not None:
+            pixel_measures.SpacingBetweenSlices = format_number_as_ds(slice_spacing)
+        elif 'SpacingBetweenSlices' in pixel_measures:
+            del pixel_measures.SpacingBetweenSlices
+    return seg
+
+
+# Planes with any foreground get consecutive dimension indices in highdicom's order
+def plane_indices(source_images, slices):
+    included = set(slices)
+    indices = {}
+    for index in plane_order(source_images).tolist():
+        if index in included:
+            indices[index] = len(indices) + 1
+    return indices
+
+
+# A single segment on regularly spaced planes is a 3D volume, as highdicom infers for the full array
+def set_dimension_organization_type(seg, source_images, segment_count, indices):
+    if segment_count != 1 or len(indices) < 2:
+        return
+    slices = sorted(indices, key=indices.get)
+    spacing, _ = get_volume_positions(
+        image_positions=[source_images[index].ImagePositionPatient for index in slices],
+        image_orientation=source_images[0].ImageOrientationPatient,
+        sort=False,
+    )
+    if spacing is not None and spacing > 0.0:
+        seg.DimensionOrganizationType = hd.DimensionOrganizationTypeValues.THREE_DIMENSIONAL.value
+
+
+# Stored value of foreground pixels
+def foreground_value(seg):
+    if seg.SegmentationType == hd.seg.SegmentationTypeValues.FRACTIONAL.value:
+        return int(seg.MaximumFractionalValue)
+    return 1
+
+
+# Keyword arguments of `highdicom.frame.encode_frame` for frames of `seg`
+def frame_encoding(seg):
+    return dict(
+        transfer_syntax_uid=seg.file_meta.TransferSyntaxUID,
+        bits_allocated=seg.BitsAllocated,
+        bits_stored=seg.BitsStored,
+        photometric_interpretation=seg.PhotometricInterpretation,
+        pixel_representation=seg.PixelRepresentation,
+    )
+
+
+# Template SEG and dimension indices of a label volume, checking its labels against the descriptions
+def sparse_template(source_images, volume, segment_descriptions, segmentation_type, transfer_syntax_uid,
+                    label_index=None, segment_labels=None, **kwargs):
+    """Return the `segmentation_template` of a label volume with its label index, segment labels and plane indices.
+
+    The label index is narrowed to `segment_labels`, see
+    `create_sparse_segmentation`; labels without a description raise a
+    `ValueError`, as does a volume without any.
+    """
+    if label_index is None:
+        label_index = LabelIndex.from_volume(volume)
+    segment_numbers = [int(desc.SegmentNumber) for desc in segment_descriptions]
+    if segment_labels is None:
+        segment_labels = segment_numbers
+    else:
+        segment_labels = [int(label) for label in segment_labels]
+        label_index = label_index.subset(segment_labels)
+    undescribed = sorted(set(label_index.labels.tolist()) - set(segment_labels))
+    if undescribed:
+        raise ValueError(f"Labels {undescribed} of the segmentation are not described in the segmentation metadata.")
+    if label_index.entries.size == 0:
+        raise ValueError("No segments found for encoding as DICOM-SEG")
+
+    seg = segmentation_template(
+        source_images, volume.shape[1:], segment_descriptions, segmentation_type, transfer_syntax_uid,
+        template_slice=int(label_index.entries[0, SLICE]), **kwargs,
+    )
+    indices = plane_indices(source_images, label_index.slices.tolist())
+    set_dimension_organization_type(seg, source_images, len(segment_numbers), indices)
+    return seg, label_index, segment_labels, indices
+
+
+def create_sparse_segmentation(source_images, volume, segment_descriptions, segmentation_type,
+                               transfer_syntax_uid, executor=None, label_index=None, segment_labels=None, **kwargs):
+    """Create a `highdicom.seg.Segmentation` from a label volume, encoding only non-empty frames.
+
+    `volume` is an integer (slices, rows, columns) label map aligned with
+    `source_images`. highdicom builds every attribute from a one-voxel
+    template plane; frames and per-frame functional groups are then
+    generated from a `LabelIndex`, so work scales with the foreground
+    instead of segments x volume size. The frame order and dimension index
+    values match what highdicom produces for the full array.
+
+    `segment_labels` gives the label of each description in `volume` when
+    it differs from the segment number; the SEG then holds only those
+    labels and other labels of the volume are left out.
+
+    The content hash of every segment is stored with its description.
+    """
+    segmentation_type = hd.seg.SegmentationTypeValues(segmentation_type)
+    seg, label_index, segment_labels, indices = sparse_template(
+        source_images, volume, segment_descriptions, segmentation_type, transfer_syntax_uid,
+        label_index, segment_labels, **kwargs,
+    )
+    segment_numbers = [int(desc.SegmentNumber) for desc in segment_descriptions]
+    frame_shape = volume.shape[1:]
+    template = seg.PerFrameFunctionalGroupsSequence[0]
+    plane_positions = {
+        index: hd.PlanePositionSequence(hd.CoordinateSystemNames.PATIENT, source_images[index].ImagePositionPatient)
+        for index in indices
+    }
+
+    value = foreground_value(seg)
+    encapsulated = seg.file_meta.TransferSyntaxUID.is_encapsulated
+    encode_kwargs = frame_encoding(seg)
+
+    items = []
+    frames = []
+    hashes = {}
+    packer = BitPacker() if seg.BitsAllocated == 1 and not encapsulated else None
+    for segment_index, (segment_number, label) in enumerate(zip(segment_numbers, segment_labels), 1):
+        entries = label_index.frames(label)
+        entries = sorted(entries.tolist(), key=lambda entry: indices[entry[SLICE]])
+        hasher = SegmentHasher()
+        for entry in entries:
+            slice_index = entry[SLICE]
+            items.append(frame_item(
+                template,
+                source_images[slice_index],
+                plane_positions[slice_index],
+                (segment_index, indices[slice_index]),
+                segment_number,
+            ))
+            frame = segment_frame(volume, entry, label, frame_shape, value)
+            hasher.add(slice_index, source_images[slice_index], entry, frame)
+            if encapsulated:
+                if executor is None:
+                    frames.append(encode_frame(frame, **encode_kwargs))
+                else:
+                    frames.append(executor.submit(encode_frame, frame, **encode_kwargs))
+            elif packer is not None:
+                frames.append(packer.add(frame))
+            else:
+                frames.append(frame.tobytes())
+        hashes[segment_number] = hasher.hexdigest()
+
+    set_segment_hashes(seg, hashes)
+    seg.PerFrameFunctionalGroupsSequence = items
+    seg.NumberOfFrames = len(items)
+    if encapsulated:
+        if executor is not None:
+            frames = [frame.result() if isinstance(frame, Future) else frame for frame in frames]
+        seg.PixelData = encapsulate(frames)
+    else:
+        if packer is not None:
+            frames.append(packer.flush())
+        pixel_data = b''.join(frames)
+        if len(pixel_data) % 2:
+            pixel_data += b'\x00'
+        seg.PixelData = pixel_data
+    return seg
@@ -0,0 +1,72 @@
+import hashlib
+
+import numpy as np
+
+from seg_writer.labels import SLICE, ROW_MIN, ROW_MAX, COLUMN_MIN, COLUMN_MAX
+
+# Private block in each SegmentSequence item holding the content hash of the segment
+PRIVATE_GROUP = 0x0071
+PRIVATE_CREATOR = "SEG_WRITER"
+SEGMENT_HASH_ELEMENT = 0x01
+
+
+class SegmentHasher:
+    """Content hash of one segment, fed one frame at a time in any order.
+
+    Every frame contributes the source image it refers to, its bounding box
+    and its bit-packed pixels inside the box. Frame digests are combined in
+    slice order, so the in-memory and the streaming writer agree.
+    """
+
+    def __init__(self):
+        self._frames = {}
+
+    def add(self, slice_index, source_image, entry, frame):
+        """Add the frame of `entry`; only nonzero pixels inside its bounding box count."""
+        box = frame[entry[ROW_MIN]:entry[ROW_MAX], entry[COLUMN_MIN]:entry[COLUMN_MAX]]
+        self.add_box(slice_index, source_image, entry, box)
+
+    def add_box(self, slice_index, source_image, entry, box):
+        """Add the frame of `entry` from the pixels inside its bounding box."""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(str(source_image.SOPInstanceUID).encode())
+        digest.update(np.asarray([entry[ROW_MIN], entry[ROW_MAX], entry[COLUMN_MIN], entry[COLUMN_MAX]], dtype='<i8').tobytes())
+        digest.update(np.packbits(box != 0).tobytes())
+        self._frames[int(slice_index)] = digest.digest()
+
+    def hexdigest(self):
+        digest = hashlib.blake2b(digest_size=16)
+        for slice_index in sorted(self._frames):
+            digest.update(self._frames[slice_index])
+        return digest.hexdigest()
+
+
+# Content hash of a segment from the label volume inside each frame's bounding box, equal to the one the writers store
+def segment_hash(volume, entries, label, source_images):
+    hasher = SegmentHasher()
+    for entry in entries:
+        slice_index = entry[SLICE]
+        box = volume[slice_index, entry[ROW_MIN]:entry[ROW_MAX], entry[COLUMN_MIN]:entry[COLUMN_MAX]] == label
+        hasher.add_box(slice_index, source_images[slice_index], entry, box)
+    return hasher.hexdigest()
+
+
+# Store segment hashes in the SegmentSequence of a SEG, keyed by segment number
+def set_segment_hashes(seg, hashes):
+    for description in seg.SegmentSequence:
+        digest = hashes.get(int(description.SegmentNumber))
+        if digest is not None:
+            block = description.private_block(PRIVATE_GROUP, PRIVATE_CREATOR, create=True)
+            block.add_new(SEGMENT_HASH_ELEMENT, 'LO', digest)
+
+
+# Segment hashes stored in a SEG, segments without one are left out
+def get_segment_hashes(seg):
+    hashes = {}
+    for description in seg.SegmentSequence:
+        try:
+            block = description.private_block(PRIVATE_GROUP, PRIVATE_CREATOR)
+            hashes[int(description.SegmentNumber)] = str(block[SEGMENT_HASH_ELEMENT].value)
+        except KeyError:
+            continue
+    return hashes
@@ -0,0 +1,136 @@
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+from seg_writer.lazy import LazyModule
+from seg_writer.series import SourceSeries, list_series_files
+
+pydicom = LazyModule("pydicom")
+
+# Number of source series kept in memory by default
+HEADER_CACHE_SIZE = 16
+
+# Bumped whenever the layout of the cache files changes
+CACHE_FORMAT = 1
+
+
+# Absolute paths of the files of a series directory or a list of file paths, None for anything else
+def _source_paths(sources):
+    if isinstance(sources, (str, os.PathLike)):
+        return sorted(os.path.abspath(path) for path in list_series_files(sources))
+    if isinstance(sources, (list, tuple)) and sources and all(isinstance(source, (str, os.PathLike)) for source in sources):
+        return sorted(os.path.abspath(source) for source in sources)
+    return None
+
+
+# Modification time and size of every file, a changed file invalidates the entry
+def _version(paths):
+    version = []
+    for path in paths:
+        stat = os.stat(path)
+        version.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(version)
+
+
+class HeaderCache:
+    """Parsed source series headers shared by conversions of the same series.
+
+    Series read from a directory or a list of file paths are kept in memory,
+    least recently used first out after `max_series`, and, with `directory`,
+    pickled to one file per series there so other processes and later runs
+    skip header parsing too. Entries are keyed by the file paths and checked
+    against their modification times and sizes, so a changed series is
+    parsed again. Cached series are shared and must not be modified, and
+    `directory` has to be trusted as its files are unpickled.
+    """
+
+    def __init__(self, max_series=HEADER_CACHE_SIZE, directory=None):
+        if max_series < 1:
+            raise ValueError(f"max_series must be at least 1, not {max_series}")
+        self.max_series = max_series
+        self.directory = directory
+        self._series = OrderedDict()
+        self._uids = {}
+        self._lock = threading.Lock()
+
+    def load(self, sources):
+        """Return the `SourceSeries` of `sources`, parsing headers only if the series is not cached.
+
+        Datasets, file-like objects and encoded bytes are not cached.
+        """
+        paths = _source_paths(sources)
+        if paths is None:
+            return SourceSeries.from_sources(sources)
+        key = tuple(paths)
+        version = _version(paths)
+
+        with self._lock:
+            entry = self._series.get(key)
+            if entry is not None and entry[0] == version:
+                self._series.move_to_end(key)
+                return entry[1]
+
+        series = self._read(key, version)
+        if series is None:
+            series = SourceSeries.from_sources(paths)
+            self._write(key, version, series)
+        self._put(key, version, series)
+        return series
+
+    def series(self, series_instance_uid):
+        """The cached series with this SeriesInstanceUID, or None."""
+        with self._lock:
+            key = self._uids.get(str(series_instance_uid))
+            return self._series[key][1] if key is not None else None
+
+    def clear(self):
+        """Drop the series held in memory, cache files are kept."""
+        with self._lock:
+            self._series.clear()
+            self._uids.clear()
+
+    def _put(self, key, version, series):
+        with self._lock:
+            self._series[key] = (version, series)
+            self._series.move_to_end(key)
+            self._uids[str(series.datasets[0].SeriesInstanceUID)] = key
+            while len(self._series) > self.max_series:
+                _, (_, evicted) = self._series.popitem(last=False)
+                uid = str(evicted.datasets[0].SeriesInstanceUID)
+                if self._uids.get(uid) not in self._series:
+                    del self._uids[uid]
+
+    def _path(self, key):
+        digest = hashlib.sha1("\n".join(key).encode()).hexdigest()
+        return os.path.join(self.directory, f"{digest}.pkl")
+
+    # Cache files from another pydicom version or for other file versions are ignored
+    def _read(self, key, version):
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), "rb") as file:
+                header = pickle.load(file)
+                if header != (CACHE_FORMAT, pydicom.__version__, key, version):
+                    return None
+                return pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+
+    # Written to a temporary file first, so concurrent writers and readers never see a partial file
+    def _write(self, key, version, series):
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.partial"
+        try:
+            with open(temp_path, "wb") as file:
+                pickle.dump((CACHE_FORMAT, pydicom.__version__, key, version), file, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(series, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
@@ -0,0 +1,143 @@
+import numpy as np
+
+# Columns of LabelIndex.entries, bounding box maxima are exclusive
+SLICE, LABEL, COUNT, ROW_MIN, ROW_MAX, COLUMN_MIN, COLUMN_MAX = range(7)
+
+# Label maps with larger values are mapped to dense indices before counting
+DIRECT_BINS = 1024
+
+# Largest label value mapped with a lookup table, larger ones are looked up in the sorted labels
+LOOKUP_LABELS = 1 << 24
+
+
+# Sorted labels of a volume and a function mapping label values to their index among them
+def _dense_labels(volume, max_label):
+    if max_label < LOOKUP_LABELS:
+        present = np.zeros(max_label + 1, dtype=bool)
+        for plane in volume:
+            present[plane] = True
+        labels = np.flatnonzero(present)
+        lookup = np.zeros(max_label + 1, dtype=np.intp)
+        lookup[labels] = np.arange(labels.size)
+        return labels, lambda values: lookup[values]
+    labels = np.unique(volume)
+    return labels, lambda values: np.searchsorted(labels, values)
+
+
+class LabelIndex:
+    """Where each label of a (slices, rows, columns) label volume is present.
+
+    Built in a single pass over the volume, one slice at a time, that counts
+    voxels per (row, label) and (column, label) with `bincount` instead of
+    sorting. `entries` has one row per (slice, label) pair present in the
+    volume, sorted by slice and label, with the voxel count and in-plane
+    bounding box of the label on that slice.
+    """
+
+    def __init__(self, entries, shape):
+        self.entries = entries
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_volume(cls, volume):
+        if volume.ndim != 3:
+            raise ValueError("A label index can only be built from a 3D label volume.")
+        if volume.dtype.kind not in 'biu':
+            raise ValueError(f"Label maps must have an integer data type, not {volume.dtype}.")
+        slices, rows, columns = volume.shape
+        if volume.dtype.kind == 'i' and volume.min(initial=0) < 0:
+            raise ValueError("Label maps can not contain negative labels.")
+
+        max_label = int(volume.max(initial=0))
+        direct = max_label < DIRECT_BINS
+        row_keys = np.repeat(np.arange(rows, dtype=np.int64), columns)
+        column_keys = np.tile(np.arange(columns, dtype=np.int64), rows)
+        if direct:
+            labels = np.arange(max_label + 1)
+            row_offsets = row_keys * labels.size
+            column_offsets = column_keys * labels.size
+        else:
+            volume_labels, to_index = _dense_labels(volume, max_label)
+            compact = volume_labels.size >= DIRECT_BINS
+            if compact:
+                slice_index_of = np.zeros(volume_labels.size, dtype=np.intp)
+            else:
+                labels = volume_labels
+                row_offsets = row_keys * labels.size
+                column_offsets = column_keys * labels.size
+
+        entries = []
+        for slice_index in range(slices):
+            bins = np.ravel(volume[slice_index])
+            if not bins.any():
+                continue
+            if not direct:
+                bins = to_index(bins)
+            if not direct and compact:
+                # Counted over the labels of this slice only, so volumes with many labels keep small bins
+                on_slice = np.flatnonzero(np.bincount(bins, minlength=volume_labels.size))
+                slice_index_of[on_slice] = np.arange(on_slice.size)
+                bins = slice_index_of[bins]
+                labels = volume_labels[on_slice]
+                row_offsets = row_keys * labels.size
+                column_offsets = column_keys * labels.size
+            size = labels.size
+            per_row = np.bincount(row_offsets + bins, minlength=rows * size).reshape(rows, size)
+            per_column = np.bincount(column_offsets + bins, minlength=columns * size).reshape(columns, size)
+            counts = per_row.sum(axis=0)
+            present = np.flatnonzero(counts)
+            present = present[labels[present] != 0]
+
+            in_rows = per_row[:, present] > 0
+            in_columns = per_column[:, present] > 0
+            block = np.empty((present.size, 7), dtype=np.int64)
+            block[:, SLICE] = slice_index
+            block[:, LABEL] = labels[present]
+            block[:, COUNT] = counts[present]
+            block[:, ROW_MIN] = in_rows.argmax(axis=0)
+            block[:, ROW_MAX] = rows - in_rows[::-1].argmax(axis=0)
+            block[:, COLUMN_MIN] = in_columns.argmax(axis=0)
+            block[:, COLUMN_MAX] = columns - in_columns[::-1].argmax(axis=0)
+            entries.append(block)
+        entries = np.concatenate(entries) if entries else np.empty((0, 7), dtype=np.int64)
+        return cls(entries, volume.shape)
+
+    @property
+    def labels(self):
+        """Sorted labels present in the volume."""
+        return np.unique(self.entries[:, LABEL])
+
+    @property
+    def slices(self):
+        """Sorted indices of slices with any foreground."""
+        return np.unique(self.entries[:, SLICE])
+
+    def voxel_counts(self):
+        """Number of voxels of each present label."""
+        labels, inverse = np.unique(self.entries[:, LABEL], return_inverse=True)
+        return dict(zip(labels.tolist(), np.bincount(inverse, weights=self.entries[:, COUNT]).astype(np.int64).tolist()))
+
+    def bounding_boxes(self):
+        """3D bounding box of each present label as (slice, row, column) start/stop pairs."""
+        if self.entries.size == 0:
+            return {}
+        entries = self.entries[np.argsort(self.entries[:, LABEL], kind='stable')]
+        starts = np.flatnonzero(np.r_[True, entries[1:, LABEL] != entries[:-1, LABEL]])
+        minima = np.minimum.reduceat(entries, starts)
+        maxima = np.maximum.reduceat(entries, starts)
+        return {
+            int(label): (
+                (int(low[SLICE]), int(high[SLICE]) + 1),
+                (int(low[ROW_MIN]), int(high[ROW_MAX])),
+                (int(low[COLUMN_MIN]), int(high[COLUMN_MAX])),
+            )
+            for label, low, high in zip(entries[starts, LABEL], minima, maxima)
+        }
+
+    def subset(self, labels):
+        """Index of only the given labels of the same volume."""
+        return LabelIndex(self.entries[np.isin(self.entries[:, LABEL], labels)], self.shape)
+
+    def frames(self, label):
+        """Entries of one label, i.e. the slices a segment has frames on."""
+        return self.entries[self.entries[:, LABEL] == label]
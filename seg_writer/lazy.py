@@ -0,0 +1,21 @@
+import importlib
+
+
+class LazyModule:
+    """Stand-in for a module that is only imported when one of its attributes is used.
+
+    Heavy dependencies (pydicom, highdicom, SimpleITK, nibabel) are bound
+    to a `LazyModule` at module level, so importing seg_writer stays cheap
+    and a dependency is loaded by the first function that needs it.
+    `importlib.import_module` takes the import lock, so the first use may
+    happen from several threads at once.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attribute):
+        return getattr(importlib.import_module(self._name), attribute)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'>"
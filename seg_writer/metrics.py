@@ -0,0 +1,173 @@
+import json
+import os
+import threading
+import time
+
+# Linux exposes per-process I/O counters and a resettable peak resident set size
+_PROC_IO = "/proc/self/io"
+_PROC_STATUS = "/proc/self/status"
+_PROC_STATM = "/proc/self/statm"
+_PROC_CLEAR_REFS = "/proc/self/clear_refs"
+
+# Seconds between resident set size samples taken while a stage runs
+MEMORY_SAMPLE_INTERVAL = 0.005
+
+
+class StageMetrics:
+    """Measurements of one stage of a conversion.
+
+    `seconds` is the wall time of the stage, `peak_memory` the growth of the
+    resident set size over its value at the start of the stage and
+    `bytes_read` / `bytes_written` the bytes passed through read and write
+    system calls, all in bytes. Memory and I/O are process-wide counters, so
+    conversions running at the same time show up in each other's stages;
+    they are None where the platform does not provide them.
+    """
+
+    __slots__ = ("stage", "seconds", "peak_memory", "bytes_read", "bytes_written")
+
+    def __init__(self, stage, seconds, peak_memory=None, bytes_read=None, bytes_written=None):
+        self.stage = stage
+        self.seconds = seconds
+        self.peak_memory = peak_memory
+        self.bytes_read = bytes_read
+        self.bytes_written = bytes_written
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"StageMetrics({fields})"
+
+
+class TimingReport:
+    """Collects the `StageMetrics` of conversions, pass it as `metrics`."""
+
+    def __init__(self):
+        self.stages = []
+
+    def __call__(self, stage_metrics):
+        self.stages.append(stage_metrics)
+
+    @property
+    def seconds(self):
+        return sum(stage.seconds for stage in self.stages)
+
+    def as_dict(self):
+        return {"seconds": self.seconds, "stages": [stage.as_dict() for stage in self.stages]}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
+
+
+# Bytes read and written by the process through system calls
+def io_counters():
+    try:
+        with open(_PROC_IO) as file:
+            counters = dict(line.split(":", 1) for line in file if ":" in line)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+# Current and peak resident set size in bytes
+def memory_usage():
+    try:
+        with open(_PROC_STATUS) as file:
+            status = dict(line.split(":", 1) for line in file if line.startswith(("VmRSS", "VmHWM")))
+        return int(status["VmRSS"].split()[0]) * 1024, int(status["VmHWM"].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+# Current resident set size in bytes, cheaper to read than the full status
+def resident_memory():
+    try:
+        with open(_PROC_STATM) as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class _MemorySampler:
+    """Largest resident set size seen by a thread sampling it until stopped.
+
+    Catches the peak of a stage that stays below an earlier peak of the
+    process, which the process-wide peak counter does not show.
+    """
+
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, resident_memory() or 0)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+# Reset the peak resident set size of the whole process to the current one, for scripts that own the process
+def reset_peak_memory():
+    try:
+        with open(_PROC_CLEAR_REFS, "w") as file:
+            file.write("5")
+    except OSError:
+        return None
+    usage = memory_usage()
+    return None if usage is None else usage[0]
+
+
+# Wrap a stage so it reports its measurements, stages run as they are without metrics
+def measure(stage, work, metrics):
+    """Return `work` wrapped to pass a `StageMetrics` to `metrics` when it completes.
+
+    Without `metrics` the function itself is returned, so a conversion that
+    is not measured does no extra work.
+    """
+    if metrics is None:
+        return work
+
+    def measured():
+        # The process peak counter is only read, clearing it would break other monitoring of the process
+        start_memory = memory_usage()
+        start_io = io_counters()
+        start = time.perf_counter()
+        if start_memory is None:
+            result = work()
+            sampled = None
+        else:
+            with _MemorySampler() as sampler:
+                result = work()
+            sampled = sampler.peak
+        seconds = time.perf_counter() - start
+        end_io = io_counters()
+        end_memory = memory_usage() if start_memory is not None else None
+
+        peak_memory = None
+        if start_memory is not None and end_memory is not None:
+            peak = max(sampled, end_memory[0])
+            # A new process peak was reached during the stage
+            if end_memory[1] > start_memory[1]:
+                peak = max(peak, end_memory[1])
+            peak_memory = max(peak - start_memory[0], 0)
+
+        metrics(StageMetrics(
+            stage,
+            seconds,
+            peak_memory=peak_memory,
+            bytes_read=None if start_io is None or end_io is None else end_io[0] - start_io[0],
+            bytes_written=None if start_io is None or end_io is None else end_io[1] - start_io[1],
+        ))
+        return result
+
+    return measured
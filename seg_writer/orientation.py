@@ -0,0 +1,93 @@
+import numpy as np
+
+# NIfTI affines are RAS+, DICOM patient coordinates are LPS+
+RAS_TO_LPS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+# Build the voxel-to-patient affine of a DICOM series
+def dicom_affine(origin, direction, spacing):
+    """Return the 4x4 affine mapping DICOM (column, row, slice) indices to LPS coordinates.
+
+    `direction` holds the column, row and slice direction cosines as the
+    columns of a 3x3 matrix (SimpleITK's `GetDirection()` layout).
+    """
+    direction = np.asarray(direction, dtype=np.float64).reshape(3, 3)
+    affine = np.eye(4)
+    affine[:3, :3] = direction * np.asarray(spacing, dtype=np.float64)
+    affine[:3, 3] = origin
+    return affine
+
+
+# Find which NIfTI axis (and direction) runs along each DICOM axis
+def axis_mapping(nifti_affine, dicom_affine_matrix, nifti_shape, dicom_shape, tolerance=1e-3):
+    """Map DICOM (column, row, slice) axes onto NIfTI voxel axes.
+
+    Returns two tuples: the NIfTI axis matching each DICOM axis and whether
+    that axis runs in the opposite direction. Raises `ValueError` if the
+    grids are not related by a pure permutation/flip of axes.
+    """
+    nifti_lps = RAS_TO_LPS @ np.asarray(nifti_affine, dtype=np.float64)
+    # DICOM index -> NIfTI index
+    index_map = np.linalg.inv(nifti_lps) @ dicom_affine_matrix
+    rotation = index_map[:3, :3]
+
+    axes = tuple(int(a) for a in np.argmax(np.abs(rotation), axis=0))
+    if sorted(axes) != [0, 1, 2]:
+        raise ValueError("The NIfTI axes can not be matched with the source DICOM axes.")
+
+    flips = []
+    for dicom_axis, nifti_axis in enumerate(axes):
+        column = rotation[:, dicom_axis]
+        step = column[nifti_axis]
+        # Both grids must share orientation (also for oblique series) and voxel size
+        if np.linalg.norm(np.delete(column, nifti_axis)) > tolerance * 10 or abs(abs(step) - 1) > 0.01:
+            raise ValueError(
+                "The NIfTI grid is rotated or scaled relative to the source DICOM series "
+                "and can not be matched by reordering axes."
+            )
+        if nifti_shape[nifti_axis] != dicom_shape[dicom_axis]:
+            raise ValueError(
+                f"The shape of nifti file with {tuple(nifti_shape)} is incompatible with shape of "
+                f"source dicom series with {(dicom_shape[2], dicom_shape[1], dicom_shape[0])}"
+            )
+        flipped = step < 0
+        # The DICOM origin has to land on the first (or last, if flipped) NIfTI voxel
+        expected_start = nifti_shape[nifti_axis] - 1 if flipped else 0
+        if abs(index_map[nifti_axis, 3] - expected_start) > 0.5:
+            raise ValueError("The NIfTI grid is shifted relative to the source DICOM series.")
+        flips.append(bool(flipped))
+
+    return axes, tuple(flips)
+
+
+# Reorient a NIfTI volume into DICOM (slices, rows, columns) order without copying
+def reorient_to_dicom(nifti_data, nifti_affine, dicom_affine_matrix, dicom_shape):
+    """Return a strided view of `nifti_data` in (slices, rows, columns) order.
+
+    `dicom_shape` is given as (columns, rows, slices). Only transposes and
+    flips are applied, so the result shares memory with `nifti_data`.
+    Axes after the third (e.g. segments of a probability map) are kept last.
+    """
+    axes, flips = axis_mapping(nifti_affine, dicom_affine_matrix, nifti_data.shape[:3], dicom_shape)
+    return apply_axis_mapping(nifti_data, axes, flips)
+
+
+# Transpose and flip NIfTI data (or a slab of it) as given by `axis_mapping`
+def apply_axis_mapping(nifti_data, axes, flips):
+    view = nifti_data.transpose(axes[2], axes[1], axes[0], *range(3, nifti_data.ndim))
+    flip_slices = tuple(slice(None, None, -1) if flips[a] else slice(None) for a in (2, 1, 0))
+    return view[flip_slices]
+
+
+# NIfTI index selecting the DICOM slices start:stop
+def nifti_slab_index(axes, flips, nifti_shape, start, stop):
+    """Return the index into NIfTI data holding DICOM slices `start` to `stop`.
+
+    The selected data still has to be reoriented with `apply_axis_mapping`.
+    """
+    slice_axis = axes[2]
+    if flips[2]:
+        start, stop = nifti_shape[slice_axis] - stop, nifti_shape[slice_axis] - start
+    index = [slice(None)] * 3
+    index[slice_axis] = slice(start, stop)
+    return tuple(index)
@@ -0,0 +1,152 @@
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from seg_writer.orientation import RAS_TO_LPS
+
+# Interpolation of a label map or probability map resampled onto the source series grid
+NEAREST = "nearest"
+LINEAR = "linear"
+INTERPOLATIONS = (NEAREST, LINEAR)
+
+# DICOM slices resampled by one task
+RESAMPLE_CHUNK_SLICES = 8
+
+# Affine entries smaller than this are treated as zero when checking for axis-aligned grids
+ALIGNED_TOLERANCE = 1e-6
+
+
+def check_interpolation(interpolation):
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError(f"Unknown interpolation {interpolation!r}, use one of {', '.join(INTERPOLATIONS)}.")
+    return interpolation
+
+
+class GridMapping:
+    """Continuous NIfTI voxel indices of every voxel of the DICOM (slices, rows, columns) grid.
+
+    Precomputed once from the NIfTI affine and the position, orientation
+    and spacing of the source series: the in-plane part of the index map is
+    evaluated for every (row, column) once and each slice only adds its
+    offset. If every DICOM axis runs along one NIfTI axis, as for a volume
+    resampled to another voxel size, each NIfTI index only depends on one
+    DICOM axis and is kept as a 1D array that broadcasts over the others.
+    """
+
+    def __init__(self, nifti_affine, dicom_affine_matrix, dicom_size):
+        # DICOM (column, row, slice) index -> NIfTI (i, j, k) index
+        index_map = np.linalg.inv(RAS_TO_LPS @ np.asarray(nifti_affine, dtype=np.float64)) @ dicom_affine_matrix
+        self.matrix = index_map[:3, :3]
+        self.offset = index_map[:3, 3]
+        columns, rows, slices = dicom_size
+        self.shape = (slices, rows, columns)
+
+        nonzero = np.abs(self.matrix) > ALIGNED_TOLERANCE
+        self.aligned = bool(np.all(nonzero.sum(axis=1) == 1) and np.all(nonzero.sum(axis=0) == 1))
+        if self.aligned:
+            # DICOM axis each NIfTI axis runs along; DICOM axis d is axis 2 - d of the output
+            self._dicom_axes = [int(np.argmax(nonzero[axis])) for axis in range(3)]
+            self._steps = [np.arange(size, dtype=np.float64) for size in (columns, rows)]
+        else:
+            row_index, column_index = np.meshgrid(np.arange(rows), np.arange(columns), indexing='ij')
+            self._plane = self.matrix[:, 0, None, None] * column_index + self.matrix[:, 1, None, None] * row_index
+
+    def coordinates(self, start, stop):
+        """NIfTI indices of DICOM slices `start` to `stop`, one array per NIfTI axis broadcasting to (slices, rows, columns)."""
+        slice_index = np.arange(start, stop, dtype=np.float64)
+        if not self.aligned:
+            return [self._plane[axis][np.newaxis] + (self.matrix[axis, 2] * slice_index + self.offset[axis])[:, None, None]
+                    for axis in range(3)]
+        coordinates = []
+        for axis, dicom_axis in enumerate(self._dicom_axes):
+            index = slice_index if dicom_axis == 2 else self._steps[dicom_axis]
+            shape = [1, 1, 1]
+            shape[2 - dicom_axis] = -1
+            coordinates.append((self.matrix[axis, dicom_axis] * index + self.offset[axis]).reshape(shape))
+        return coordinates
+
+
+# Integer indices of `coordinates` clipped to the volume, with the mask of indices inside it
+def _clip(indices, shape):
+    clipped, inside = [], True
+    for index, size in zip(indices, shape):
+        inside = inside & (index >= 0) & (index < size)
+        clipped.append(np.clip(index, 0, size - 1))
+    return tuple(clipped), inside
+
+
+def _nearest(data, coordinates, shape):
+    index, inside = _clip([np.floor(coordinate + 0.5).astype(np.intp) for coordinate in coordinates], data.shape)
+    values = data[index]
+    # Voxels outside the label map are background
+    values[~np.broadcast_to(inside, shape)] = 0
+    return values
+
+
+# Interpolated values of the eight neighbours, with their trilinear weights
+def _neighbours(data, coordinates, shape):
+    floors = [np.floor(coordinate) for coordinate in coordinates]
+    fractions = [coordinate - floor for coordinate, floor in zip(coordinates, floors)]
+    floors = [floor.astype(np.intp) for floor in floors]
+    for corner in itertools.product((0, 1), repeat=3):
+        index, inside = _clip([floor + step for floor, step in zip(floors, corner)], data.shape)
+        weight = np.ones((1, 1, 1), dtype=np.float32)
+        for fraction, step in zip(fractions, corner):
+            weight = weight * (fraction if step else 1 - fraction).astype(np.float32)
+        values = data[index]
+        values[~np.broadcast_to(inside, shape)] = 0
+        yield values, np.broadcast_to(weight, shape)
+
+
+def _linear(data, coordinates, shape):
+    if data.dtype.kind == 'f':
+        result = np.zeros(shape + data.shape[3:], dtype=data.dtype)
+        for values, weight in _neighbours(data, coordinates, shape):
+            result += weight.reshape(shape + (1,) * (data.ndim - 3)) * values
+        return result
+
+    # Label-aware: every neighbour votes for its label with its weight, the label with most weight wins
+    neighbours = list(_neighbours(data, coordinates, shape))
+    result = np.zeros(shape + data.shape[3:], dtype=data.dtype)
+    best = np.full(shape, -1.0, dtype=np.float32)
+    for candidate, _ in neighbours:
+        score = np.zeros(shape, dtype=np.float32)
+        for values, weight in neighbours:
+            score += np.where(values == candidate, weight, 0)
+        better = score > best
+        result[better] = candidate[better]
+        best[better] = score[better]
+    return result
+
+
+def resample_to_dicom(nifti_data, nifti_affine, dicom_affine_matrix, dicom_size, interpolation=NEAREST, workers=None,
+                      chunk_slices=RESAMPLE_CHUNK_SLICES):
+    """Resample a NIfTI label map or probability map of any grid onto the DICOM grid.
+
+    `dicom_size` is given as (columns, rows, slices) and the result is in
+    (slices, rows, columns) order, axes after the third kept last. Voxels
+    outside the NIfTI volume are background. `"nearest"` takes the nearest
+    NIfTI voxel; `"linear"` interpolates probability maps trilinearly and
+    gives each label map voxel the label with the largest trilinear weight
+    among its eight neighbours. Chunks of `chunk_slices` slices are
+    resampled in `workers` threads.
+    """
+    check_interpolation(interpolation)
+    nifti_data = np.asarray(nifti_data)
+    mapping = GridMapping(nifti_affine, dicom_affine_matrix, dicom_size)
+    # Rounding of the weights may take interpolated probabilities just past the input range
+    value_range = (min(nifti_data.min(initial=0), 0), nifti_data.max(initial=0)) if nifti_data.dtype.kind == 'f' else None
+    slices, rows, columns = mapping.shape
+    result = np.empty(mapping.shape + nifti_data.shape[3:], dtype=nifti_data.dtype)
+    sample = _nearest if interpolation == NEAREST else _linear
+
+    def resample_chunk(start):
+        stop = min(start + chunk_slices, slices)
+        result[start:stop] = sample(nifti_data, mapping.coordinates(start, stop), (stop - start, rows, columns))
+        if value_range is not None and interpolation == LINEAR:
+            np.clip(result[start:stop], *value_range, out=result[start:stop])
+
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(resample_chunk, range(0, slices, chunk_slices)))
+    return result
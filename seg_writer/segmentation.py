@@ -0,0 +1,72 @@
+import numpy as np
+
+from seg_writer.lazy import LazyModule
+
+nib = LazyModule("nibabel")
+
+
+class LoadedSegmentation:
+    """A NIfTI label map decoded once, in its native integer dtype.
+
+    `data` keeps the NIfTI voxel order (i, j, k[, ...]) and `affine` the
+    RAS+ affine from the header. Validation, label discovery and
+    reorientation all work on this object instead of reading the file again.
+    """
+
+    def __init__(self, data, affine):
+        self.data = data
+        self.affine = np.asarray(affine, dtype=np.float64)
+
+    @classmethod
+    def from_file(cls, nifti_file_path, label_map=True):
+        """Decode a NIfTI file, `label_map=False` keeps float probability maps as they are."""
+        nifti_img = nib.load(str(nifti_file_path))
+        # dataobj keeps the on-disk dtype unless the header asks for scaling
+        data = np.asanyarray(nifti_img.dataobj)
+        if label_map and data.dtype.kind == 'f':
+            data = _float_to_labels(data)
+        return cls(data, nifti_img.affine)
+
+    @classmethod
+    def open(cls, nifti_file_path):
+        """Open a NIfTI file without decoding it.
+
+        `data` is a memory map for uncompressed files without scaling and a
+        nibabel array proxy otherwise, so voxels are only read when indexed
+        with `read`. The file stays open between reads, so slabs of a
+        `.nii.gz` file are decompressed in one pass instead of from the start
+        for every slab.
+        """
+        nifti_img = nib.load(str(nifti_file_path), mmap='r', keep_file_open=True)
+        data = nifti_img.dataobj
+        if not str(nifti_file_path).endswith('.gz') and data.slope == 1 and data.inter == 0:
+            data = np.asanyarray(data)
+        return cls(data, nifti_img.affine)
+
+    def read(self, index, label_map=True):
+        """Read part of `data`, converting float label maps like `from_file`."""
+        data = np.asanyarray(self.data[index])
+        if label_map and data.dtype.kind == 'f':
+            data = _float_to_labels(data)
+        return data
+
+    @property
+    def components(self):
+        """Number of components per voxel."""
+        if self.data.dtype.names:
+            return len(self.data.dtype.names)
+        return int(np.prod(self.data.shape[3:], dtype=np.int64))
+
+    @property
+    def volume(self):
+        """The 3D label volume, dropping a trailing singleton dimension."""
+        if self.data.ndim > 3 and self.components == 1:
+            return self.data.reshape(self.data.shape[:3])
+        return self.data
+
+
+# Label maps stored as floats are converted once to the smallest fitting unsigned type
+def _float_to_labels(data):
+    if not np.all(np.mod(data, 1) == 0) or data.min(initial=0) < 0:
+        raise ValueError("Segmentation contains non-integer or negative values and can not be used as a label map.")
+    return data.astype(np.min_scalar_type(int(data.max(initial=0))))
@@ -0,0 +1,112 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from seg_writer.lazy import LazyModule
+from seg_writer.orientation import dicom_affine
+
+pydicom = LazyModule("pydicom")
+
+
+# Read one DICOM header and drop 'NumberOfFrames' so it is handled as a single frame image
+def read_header(elem):
+    """Return the header of a DICOM file, file-like object or dataset without 'NumberOfFrames'.
+
+    A dataset passed in is copied before the tag is removed, so the caller's
+    dataset is left as it is.
+    """
+    if isinstance(elem, pydicom.Dataset):
+        if 'NumberOfFrames' not in elem:
+            return elem
+        dcm = pydicom.Dataset(dict(elem.items()))
+        if hasattr(elem, 'file_meta'):
+            dcm.file_meta = elem.file_meta
+    else:
+        if isinstance(elem, (bytes, bytearray, memoryview)):
+            elem = io.BytesIO(elem)
+        dcm = pydicom.dcmread(elem, stop_before_pixels=True, force=True)
+    if 'NumberOfFrames' in dcm:
+        del dcm.NumberOfFrames
+    return dcm
+
+
+# List DICOM files of a series directory
+def list_series_files(dicom_series_path):
+    return [os.path.join(dicom_series_path, i) for i in os.listdir(dicom_series_path) if '.dcm' in i]
+
+
+class SourceSeries:
+    """Headers and geometry of a source DICOM series, parsed once.
+
+    Datasets are sorted along the slice normal, so `datasets[i]` is the
+    source image of frame `i` of any array in (slices, rows, columns) order.
+    Pixel data is never read.
+    """
+
+    def __init__(self, datasets):
+        if len(datasets) == 0:
+            raise ValueError("No DICOM files found in the source series.")
+
+        first = datasets[0]
+        orientation = np.asarray(first.ImageOrientationPatient, dtype=np.float64)
+        row_cosine, column_cosine = orientation[:3], orientation[3:]
+        normal = np.cross(row_cosine, column_cosine)
+
+        positions = np.array([ds.ImagePositionPatient for ds in datasets], dtype=np.float64)
+        order = np.argsort(positions @ normal, kind='stable')
+
+        self.datasets = [datasets[i] for i in order]
+        self.positions = positions[order]
+        self.direction = np.column_stack([row_cosine, column_cosine, normal])
+        self.rows = int(first.Rows)
+        self.columns = int(first.Columns)
+
+        # PixelSpacing is (row spacing, column spacing)
+        row_spacing, column_spacing = (float(v) for v in first.PixelSpacing)
+        if len(self.datasets) > 1:
+            slice_spacing = float(np.median(np.diff(self.positions @ normal)))
+        else:
+            slice_spacing = float(getattr(first, 'SliceThickness', None) or 1.0)
+        self.spacing = (column_spacing, row_spacing, slice_spacing)
+
+    @classmethod
+    def from_path(cls, dicom_series_path):
+        """Parse every header of a series directory in parallel threads."""
+        return cls.from_sources(list_series_files(dicom_series_path))
+
+    @classmethod
+    def from_sources(cls, sources):
+        """Build the series from a directory or from datasets, file paths, file-like objects or encoded bytes."""
+        if isinstance(sources, SourceSeries):
+            return sources
+        if isinstance(sources, (str, os.PathLike)):
+            return cls.from_path(sources)
+        sources = list(sources)
+        if all(isinstance(source, pydicom.Dataset) for source in sources):
+            return cls([read_header(source) for source in sources])
+        with ThreadPoolExecutor() as executor:
+            datasets = list(executor.map(read_header, sources))
+        return cls(datasets)
+
+    def __len__(self):
+        return len(self.datasets)
+
+    @property
+    def origin(self):
+        return self.positions[0]
+
+    @property
+    def shape(self):
+        """Shape of a segmentation on this series as (slices, rows, columns)."""
+        return (len(self.datasets), self.rows, self.columns)
+
+    @property
+    def size(self):
+        """Grid size as (columns, rows, slices), matching the affine index order."""
+        return (self.columns, self.rows, len(self.datasets))
+
+    @property
+    def affine(self):
+        return dicom_affine(self.origin, self.direction, self.spacing)
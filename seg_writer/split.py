@@ -0,0 +1,97 @@
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
+import highdicom as hd
+import numpy as np
+
+from seg_writer.frames import create_sparse_segmentation
+from seg_writer.labels import LABEL
+
+
+# Number of frames of each present label, one per slice it is found on
+def frame_counts(label_index):
+    labels, counts = np.unique(label_index.entries[:, LABEL], return_counts=True)
+    return dict(zip(labels.tolist(), counts.tolist()))
+
+
+def plan_instances(label_index, segment_numbers, max_frames=None, segment_groups=None):
+    """Split the labels present in a label map into the label lists of several SEG instances.
+
+    `segment_groups` gives the labels of each instance; present labels of no
+    group go to one more instance at the end. Groups holding more than
+    `max_frames` frames are split further, keeping a segment's frames in one
+    instance, so a single segment may exceed the budget on its own. Labels
+    without voxels get no instance.
+    """
+    if max_frames is not None and max_frames < 1:
+        raise ValueError(f"max_frames must be at least 1, not {max_frames}")
+    counts = frame_counts(label_index)
+    described = set(int(number) for number in segment_numbers)
+
+    if segment_groups is None:
+        groups = [[number for number in segment_numbers if int(number) in counts]]
+    else:
+        groups = [[int(label) for label in group] for group in segment_groups]
+        grouped = [label for group in groups for label in group]
+        duplicated = sorted(label for label in set(grouped) if grouped.count(label) > 1)
+        if duplicated:
+            raise ValueError(f"Labels {duplicated} are listed in more than one segment group.")
+        undescribed = sorted(set(grouped) - described)
+        if undescribed:
+            raise ValueError(f"Labels {undescribed} of the segment groups are not described in the segmentation metadata.")
+        ungrouped = [int(number) for number in segment_numbers if int(number) in counts and int(number) not in grouped]
+        groups.append(ungrouped)
+
+    instances = []
+    for group in groups:
+        labels, frames = [], 0
+        for label in (int(label) for label in group if int(label) in counts):
+            if labels and max_frames is not None and frames + counts[label] > max_frames:
+                instances.append(labels)
+                labels, frames = [], 0
+            labels.append(label)
+            frames += counts[label]
+        if labels:
+            instances.append(labels)
+    if not instances:
+        raise ValueError("No segments found for encoding as DICOM-SEG")
+    return instances
+
+
+# Segment numbers of every instance start at 1, as BINARY and FRACTIONAL segmentations require
+def instance_descriptions(segment_descriptions, labels):
+    """Return copies of the descriptions of `labels`, renumbered from 1 in the given order."""
+    by_label = {int(description.SegmentNumber): description for description in segment_descriptions}
+    descriptions = []
+    for segment_number, label in enumerate(labels, 1):
+        description = copy.deepcopy(by_label[label])
+        description.SegmentNumber = segment_number
+        descriptions.append(description)
+    return descriptions
+
+
+def create_split_segmentations(source_images, volume, segment_descriptions, segmentation_type, transfer_syntax_uid,
+                               instances, label_index, workers=None, executor=None, **kwargs):
+    """Build one `highdicom.seg.Segmentation` per label list of `instances`, in parallel threads.
+
+    All instances share the series attributes in `kwargs` and are numbered
+    from 1 in the order of `instances`; each gets its own SOP Instance UID.
+    Frames are read from the shared `volume` and `label_index`, compressed
+    frames are encoded in `executor`.
+    """
+    def build(numbered):
+        instance_number, labels = numbered
+        return create_sparse_segmentation(
+            source_images,
+            volume,
+            instance_descriptions(segment_descriptions, labels),
+            segmentation_type,
+            transfer_syntax_uid,
+            executor=executor,
+            label_index=label_index,
+            segment_labels=labels,
+            **dict(kwargs, sop_instance_uid=hd.UID(), instance_number=instance_number),
+        )
+
+    with ThreadPoolExecutor(workers) as builders:
+        return list(builders.map(build, enumerate(instances, 1)))
@@ -0,0 +1,79 @@
+import asyncio
+import inspect
+import time
+
+from seg_writer.metrics import measure
+
+# Stages of a conversion, in the order they run
+LOAD = "load"
+RESAMPLE = "resample"
+VALIDATE = "validate"
+BUILD = "build"
+ENCODE = "encode"
+WRITE = "write"
+STAGES = (LOAD, RESAMPLE, VALIDATE, BUILD, ENCODE, WRITE)
+
+# Stages that mostly wait on the file system
+IO_STAGES = frozenset((LOAD, WRITE))
+
+
+# Run a conversion, given as a generator of stages, in the calling thread
+def run_stages(stages, progress=None, metrics=None):
+    """Run the stages of a conversion one after the other.
+
+    `stages` is a generator yielding `(stage, function)` pairs. The result
+    of each function is sent back into the generator and the value it
+    returns is the result of the conversion. `progress(stage, seconds)` is
+    called after every stage and `metrics`, if given, receives the
+    `StageMetrics` of every stage (see `seg_writer.metrics`).
+    """
+    result = None
+    try:
+        while True:
+            try:
+                stage, work = stages.send(result)
+            except StopIteration as stop:
+                return stop.value
+            start = time.perf_counter()
+            result = measure(stage, work, metrics)()
+            if progress is not None:
+                progress(stage, time.perf_counter() - start)
+    finally:
+        # Lets the conversion remove partial output if a stage failed
+        stages.close()
+
+
+# Run a conversion, given as a generator of stages, without blocking the event loop
+async def run_stages_async(stages, progress=None, executor=None, io_executor=None, metrics=None):
+    """Await the stages of a conversion, running each one in an executor.
+
+    File system stages (`IO_STAGES`) run in `io_executor` and all other
+    stages in `executor`, both default to the event loop's default executor.
+    Stages share in-memory state, so the executors have to run threads.
+    `progress(stage, seconds)` may be a plain function or a coroutine
+    function; `metrics` is called from the executor threads. A cancelled
+    conversion stops at the next stage boundary, after the running stage
+    finished and its partial output was removed.
+    """
+    loop = asyncio.get_running_loop()
+    result = None
+    try:
+        while True:
+            try:
+                stage, work = stages.send(result)
+            except StopIteration as stop:
+                return stop.value
+            start = time.perf_counter()
+            future = loop.run_in_executor(io_executor if stage in IO_STAGES else executor, measure(stage, work, metrics))
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # A stage running in a thread can not be interrupted
+                await asyncio.wait([future])
+                raise
+            if progress is not None:
+                outcome = progress(stage, time.perf_counter() - start)
+                if inspect.isawaitable(outcome):
+                    await outcome
+    finally:
+        stages.close()
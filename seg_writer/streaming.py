@@ -0,0 +1,257 @@
+import struct
+import tempfile
+import zlib
+from collections import defaultdict, deque
+from functools import partial
+
+import numpy as np
+import highdicom as hd
+from highdicom.frame import encode_frame
+from pydicom.charset import default_encoding
+from pydicom.dataset import Dataset
+from pydicom.encaps import itemize_fragment, itemize_frame
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_dataset
+from pydicom.tag import Tag
+
+from seg_writer.frames import (
+    BitPacker, foreground_value, frame_encoding, frame_item, plane_indices, segment_frame, segmentation_template,
+    set_dimension_organization_type,
+)
+from seg_writer.hashes import SegmentHasher, set_segment_hashes
+from seg_writer.labels import LabelIndex, SLICE, LABEL
+from seg_writer.orientation import apply_axis_mapping, axis_mapping, nifti_slab_index
+from seg_writer.utils import frame_transfer_syntax_for, segmentation_type_for, write_streamed
+
+# Number of DICOM slices read from the NIfTI file at a time
+DEFAULT_SLAB_SIZE = 32
+
+# Maximum number of frames queued for encoding at a time
+ENCODE_WINDOW = 64
+
+_PER_FRAME_FUNCTIONAL_GROUPS_SEQUENCE = Tag(0x52009230)
+_PIXEL_DATA = Tag(0x7FE00010)
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+_SEQUENCE_DELIMITER = struct.pack('<HHL', 0xFFFE, 0xE0DD, 0)
+
+
+# Explicit VR little endian header of an SQ or OB element
+def _element_header(tag, vr, length):
+    return struct.pack('<HH2sHL', tag.group, tag.element, vr, 0, length)
+
+
+class FrameSpool:
+    """Encoded frames kept in a temporary file until the output is written.
+
+    Frames can be added in any order and are read back per segment, so a
+    volume is only read once even though frames are stored segment by segment.
+    """
+
+    def __init__(self, directory=None):
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._frames = defaultdict(list)
+        self._size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, segment_number, slice_index, data):
+        self._frames[int(segment_number)].append((int(slice_index), self._size, len(data)))
+        self._file.write(data)
+        self._size += len(data)
+
+    def frames(self, segment_number):
+        """(slice index, offset, length) of each frame of one segment."""
+        return self._frames.get(int(segment_number), [])
+
+    def read(self, offset, length):
+        self._file.seek(offset)
+        return self._file.read(length)
+
+    def close(self):
+        self._file.close()
+
+
+# Encode a sequence as an undefined length element, one item at a time; encoded items are written as they are
+def sequence_chunks(tag, items, character_set):
+    yield _element_header(tag, b'SQ', _UNDEFINED_LENGTH)
+    for item in items:
+        if not isinstance(item, Dataset):
+            yield item
+            continue
+        buffer = DicomBytesIO()
+        buffer.is_little_endian = True
+        buffer.is_implicit_VR = False
+        write_dataset(buffer, item, character_set)
+        data = buffer.getvalue()
+        yield struct.pack('<HHL', 0xFFFE, 0xE000, len(data)) + data
+    yield _SEQUENCE_DELIMITER
+
+
+# Encode native PixelData from spooled frames, packing bits that were not packed per frame
+def native_pixel_chunks(frames, length, packer=None):
+    yield _element_header(_PIXEL_DATA, b'OB', length + length % 2)
+    for data in frames:
+        if packer is not None:
+            data = packer.add(np.frombuffer(data, dtype=np.uint8))
+        yield data
+    if packer is not None:
+        yield packer.flush()
+    if length % 2:
+        yield b'\x00'
+
+
+# Encode encapsulated PixelData from spooled frames, with a basic offset table
+def encapsulated_pixel_chunks(frames, lengths):
+    yield _element_header(_PIXEL_DATA, b'OB', _UNDEFINED_LENGTH)
+    offsets = np.cumsum([0] + [8 + length + length % 2 for length in lengths[:-1]], dtype=np.int64)
+    # Offsets are 32 bit, larger files are written with an empty table
+    if offsets[-1] < 2 ** 32:
+        yield itemize_fragment(struct.pack(f'<{len(offsets)}L', *offsets.tolist()))
+    else:
+        yield itemize_fragment(b'')
+    for data in frames:
+        yield from itemize_frame(data)
+    yield _SEQUENCE_DELIMITER
+
+
+def write_streamed_segmentation(segmentation, source_series, segment_descriptions, output_file_path,
+                                segmentation_type, transfer_syntax, compression_level=zlib.Z_DEFAULT_COMPRESSION,
+                                slab_size=DEFAULT_SLAB_SIZE, executor=None, spool_directory=None, **kwargs):
+    """Write a DICOM SEG from a NIfTI label map without holding the volume or all frames in memory.
+
+    `segmentation` is a `LoadedSegmentation` opened with `open`, so only
+    `slab_size` DICOM slices of it are read at a time. Each slab is indexed
+    and its non-empty frames are encoded into a `FrameSpool`; the output is
+    then written element by element, generating per-frame functional groups
+    and PixelData from the spool in highdicom's frame order. Peak memory is
+    bounded by the slab size, the frames queued for encoding and the label
+    index.
+    """
+    segmentation_type = segmentation_type_for(segmentation_type)
+    if segmentation.components > 1:
+        raise ValueError(
+            "Multi-class segmentations can only be "
+            "represented with a single component per voxel."
+        )
+    if slab_size < 1:
+        raise ValueError("The slab size must be at least one slice.")
+
+    source_images = source_series.datasets
+    frame_shape = (source_series.rows, source_series.columns)
+    segment_numbers = [int(desc.SegmentNumber) for desc in segment_descriptions]
+    seg = segmentation_template(
+        source_images, frame_shape, segment_descriptions, segmentation_type,
+        frame_transfer_syntax_for(transfer_syntax), **kwargs,
+    )
+    template = seg.PerFrameFunctionalGroupsSequence[0]
+    del seg.PerFrameFunctionalGroupsSequence
+    del seg.PixelData
+
+    value = foreground_value(seg)
+    encapsulated = seg.file_meta.TransferSyntaxUID.is_encapsulated
+    encode = partial(encode_frame, **frame_encoding(seg))
+    bit_packed = seg.BitsAllocated == 1 and not encapsulated
+    # Frames that do not fill whole bytes are packed while writing, as frames share bytes
+    pack_on_write = bit_packed and (frame_shape[0] * frame_shape[1]) % 8 != 0
+
+    nifti_shape = segmentation.data.shape
+    axes, flips = axis_mapping(segmentation.affine, source_series.affine, nifti_shape[:3], source_series.size)
+
+    with FrameSpool(spool_directory) as spool:
+        entries = []
+        hashers = {}
+        starts = range(0, len(source_series), slab_size)
+        # Slabs are read in file order, so a .nii.gz file is decompressed in one forward pass
+        if flips[2]:
+            starts = reversed(starts)
+        for start in starts:
+            stop = min(start + slab_size, len(source_series))
+            slab = segmentation.read(nifti_slab_index(axes, flips, nifti_shape, start, stop))
+            slab = apply_axis_mapping(slab, axes, flips)
+            slab = slab.reshape(slab.shape[:3])
+            if slab.dtype.kind not in 'biu':
+                raise ValueError("Only label maps can be written slab by slab.")
+
+            slab_index = LabelIndex.from_volume(slab)
+            undescribed = sorted(set(slab_index.labels.tolist()) - set(segment_numbers))
+            if undescribed:
+                raise ValueError(f"Labels {undescribed} of the segmentation are not described in the segmentation metadata.")
+
+            pending = deque()
+            for entry in slab_index.entries:
+                frame = segment_frame(slab, entry, entry[LABEL], frame_shape, value)
+                slice_index = start + entry[SLICE]
+                hashers.setdefault(int(entry[LABEL]), SegmentHasher()).add(slice_index, source_images[slice_index], entry, frame)
+                if encapsulated and executor is not None:
+                    pending.append((entry, executor.submit(encode, frame)))
+                    # Bound the number of frames held while they are encoded
+                    while len(pending) > ENCODE_WINDOW:
+                        done, future = pending.popleft()
+                        spool.add(done[LABEL], start + done[SLICE], future.result())
+                    continue
+                if encapsulated:
+                    data = encode(frame)
+                elif bit_packed and not pack_on_write:
+                    data = np.packbits(frame, bitorder='little').tobytes()
+                else:
+                    data = frame.tobytes()
+                spool.add(entry[LABEL], start + entry[SLICE], data)
+            for done, future in pending:
+                spool.add(done[LABEL], start + done[SLICE], future.result())
+
+            slab_index.entries[:, SLICE] += start
+            entries.append(slab_index.entries)
+            del slab
+
+        if flips[2]:
+            entries.reverse()
+        label_index = LabelIndex(np.concatenate(entries), source_series.shape)
+        if label_index.entries.size == 0:
+            raise ValueError("No segments found for encoding as DICOM-SEG")
+        set_segment_hashes(seg, {number: hashers.get(number, SegmentHasher()).hexdigest() for number in segment_numbers})
+
+        # Frames in highdicom's order: by segment, then by plane along the normal
+        indices = plane_indices(source_images, label_index.slices.tolist())
+        set_dimension_organization_type(seg, source_images, len(segment_numbers), indices)
+        order = []
+        for segment_index, segment_number in enumerate(segment_numbers, 1):
+            for slice_index, offset, length in sorted(spool.frames(segment_number), key=lambda f: indices[f[0]]):
+                order.append((segment_index, segment_number, slice_index, offset, length))
+        seg.NumberOfFrames = len(order)
+
+        plane_positions = {}
+
+        def items():
+            for segment_index, segment_number, slice_index, _, _ in order:
+                if slice_index not in plane_positions:
+                    plane_positions[slice_index] = hd.PlanePositionSequence(
+                        hd.CoordinateSystemNames.PATIENT, source_images[slice_index].ImagePositionPatient
+                    )
+                yield frame_item(
+                    template,
+                    source_images[slice_index],
+                    plane_positions[slice_index],
+                    (segment_index, indices[slice_index]),
+                    segment_number,
+                )
+
+        frames = (spool.read(offset, length) for _, _, _, offset, length in order)
+        lengths = [length for _, _, _, _, length in order]
+        if encapsulated:
+            pixel_chunks = encapsulated_pixel_chunks(frames, lengths)
+        elif pack_on_write:
+            pixel_chunks = native_pixel_chunks(frames, (sum(lengths) + 7) // 8, BitPacker())
+        else:
+            pixel_chunks = native_pixel_chunks(frames, sum(lengths))
+
+        character_set = seg.get('SpecificCharacterSet', default_encoding)
+        return write_streamed(seg, output_file_path, transfer_syntax, compression_level, streamed={
+            _PER_FRAME_FUNCTIONAL_GROUPS_SEQUENCE: sequence_chunks(
+                _PER_FRAME_FUNCTIONAL_GROUPS_SEQUENCE, items(), character_set
+            ),
+            _PIXEL_DATA: pixel_chunks,
+        })
@@ -1,77 +1,145 @@
 import csv
+import functools
 import numpy as np
-import SimpleITK
-from palettable.tableau import tableau
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
+from seg_writer.lazy import LazyModule
+from seg_writer.segmentation import LoadedSegmentation
 
-# Get color palette
-colormap = tableau.get_map("Tableau_20")
+SimpleITK = LazyModule("SimpleITK")
+
+
+# Get color palette, palettable is only imported when colors are needed
+@functools.lru_cache(maxsize=None)
+def get_colormap():
+    from palettable.tableau import tableau
+    return tableau.get_map("Tableau_20")
+
+
+# `colormap` is still available as a module attribute
+def __getattr__(name):
+    if name == "colormap":
+        return get_colormap()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # Default CSV delimiter
 CSV_DELIMITER = ","
 
+# Number of slices read at a time when collecting the labels of a NIfTI file
+LABEL_SLAB_SIZE = 64
+
+# Segmentation files picked up by `create_metadata_batch`
+SEGMENTATION_SUFFIXES = (".nii", ".nii.gz")
+
+# Category of every segment, SNOMED "Tissue"
+CATEGORY_CODE_VALUE = "85756007"
+
+
+# Read the label CSV once into {label_id: label_name}, in file order
+def read_label_csv(csv_path):
+    with open(csv_path, newline="") as file:
+        return {int(row[0].strip()): row[1].strip() for row in csv.reader(file, delimiter=CSV_DELIMITER) if row}
+
+
 # Parse csv
 def parse_csv(csv_path):
-    with open(csv_path) as file:
-        csv_reader = csv.reader(file, delimiter=CSV_DELIMITER)
-        len_label_id = 0
-        labels = []
-        for row in csv_reader:
-            label_id = int(row[0].strip())
-            labels.append(label_id)
-            len_label_id +=1
-    return len_label_id , labels
+    labels = list(read_label_csv(csv_path))
+    return len(labels), labels
+
+
+# Sorted nonzero values of a label map; small unsigned labels are counted with bincount instead of sorted
+def present_labels(data):
+    data = np.asarray(data)
+    if data.dtype.kind in "bu" and data.dtype.itemsize <= 2:
+        return np.flatnonzero(np.bincount(data.ravel()))[1:] if data.any() else np.empty(0, dtype=np.int64)
+    values = np.unique(data)
+    return values[values != 0]
+
+
+def find_labels(segmentation, slab_size=LABEL_SLAB_SIZE):
+    """Labels present in a segmentation file, `LoadedSegmentation` or array.
+
+    NIfTI files are read `slab_size` slices at a time, so the whole volume
+    is never held in memory; other formats are read with SimpleITK.
+    """
+    if isinstance(segmentation, (str, os.PathLike)):
+        if not os.path.exists(segmentation):
+            raise ValueError(f"The provided {segmentation} is not supported or can not accessible.")
+        if not str(segmentation).endswith(SEGMENTATION_SUFFIXES):
+            return present_labels(SimpleITK.GetArrayViewFromImage(SimpleITK.ReadImage(str(segmentation))))
+        segmentation = LoadedSegmentation.open(segmentation)
+
+    if isinstance(segmentation, LoadedSegmentation):
+        data = segmentation.data
+        if len(data.shape) < 3:
+            return present_labels(segmentation.read(Ellipsis, label_map=False))
+        labels = np.empty(0, dtype=np.int64)
+        for start in range(0, data.shape[2], slab_size):
+            slab = segmentation.read((slice(None), slice(None), slice(start, start + slab_size)), label_map=False)
+            labels = np.union1d(labels, present_labels(slab))
+        return labels
+
+    if isinstance(segmentation, np.ndarray):
+        return present_labels(segmentation)
+    raise ValueError(f"The provided {segmentation} is not supported or can not accessible.")
+
+
+# Labels to describe: those present in the segmentation, or every CSV label if the counts differ
+def select_labels(labels, label_names):
+    labels = [int(label) for label in labels]
+    if len(labels) != len(label_names):
+        labels = list(label_names)
+    return labels
+
 
 # Func to Get class ID form segmentation
-def get_labels(segmentation,csv_path):
-    print("Reading segmentation to identify ROIs...")
-    if isinstance(segmentation,str):
-        if os.path.exists(segmentation):
-            image = SimpleITK.ReadImage(segmentation)
-            image_data = SimpleITK.GetArrayFromImage(image)
-            labels = np.trim_zeros(np.unique(image_data))
-    elif isinstance(segmentation, np.ndarray):
-        labels = np.trim_zeros(np.unique(segmentation))
+def get_labels(segmentation, csv_path):
+    return select_labels(find_labels(segmentation), read_label_csv(csv_path))
 
-    else:
-        raise ValueError(f"The provided {segmentation} is not supported or can not accessible.")
-    
-    all_lables , whole_label = parse_csv(csv_path)
-    if len(labels) != all_lables:
-        labels = whole_label
 
-    return labels
+# Class names of `labels` from the label CSV, in CSV order
+def map_label_names(label_names, labels):
+    wanted = set(int(label) for label in labels)
+    missing = [label for label in labels if int(label) not in label_names]
+    if missing:
+        raise ValueError(f"Label with pixel value {missing[0]} is not present in the CSV file!")
+    return {label_id: label_name for label_id, label_name in label_names.items() if label_id in wanted}
 
 
 # Get class name's from CSV file that user supplied
 def parse_labelmap_file(labelmap_path, labels):
-    labels_dict = {}
-    line_count = 0
-
-    with open(labelmap_path) as csv_file:
-        csv_reader = csv.reader(csv_file, delimiter=CSV_DELIMITER)
-        for row in csv_reader:
-            label_id = int(row[0].strip())
-            label_name = row[1].strip()
-            if label_id in labels:  # only include ids that are actually present in file
-                labels_dict[label_id] = label_name
-            line_count += 1
-
-        for label in labels:  # check that all labels present in image are included in labels_dict
-            if label not in labels_dict:
-                raise ValueError(f"Label with pixel value {label} is not present in the CSV file!")
-        print(
-            f"{len(labels)}/{len(labels)} labels correctly mapped with the provided CSV file, generating metadata file now..."
-        )
-    return labels_dict
+    return map_label_names(read_label_csv(labelmap_path), labels)
+
+
+def read_code_table(code_table_path):
+    """Read a code lookup CSV into {label: row}.
+
+    The CSV has a header row with the columns `label`, `CodeValue` and
+    `CodeMeaning` and, optionally, `CodingSchemeDesignator` (default SCT),
+    `CategoryCodeValue`, `CategoryCodeMeaning` and
+    `CategoryCodingSchemeDesignator`. `label` holds the label name or ID.
+    """
+    with open(code_table_path, newline="") as file:
+        return {row["label"].strip(): row for row in csv.DictReader(file, delimiter=CSV_DELIMITER)}
+
+
+# Code table row of a label, looked up by name first and by ID second
+def lookup_code(codes, label, description):
+    if not codes:
+        return None
+    for key in (description, int(label), str(int(label))):
+        if key in codes:
+            return codes[key]
+    return None
+
 
 # Generate Metadata from each class
-def generate_metadata(roi_dict, series_description="Segmentation"):
+def generate_metadata(roi_dict, series_description="Segmentation", codes=None):
     if roi_dict is not None:
-        segment_attributes = [get_segments(roi_dict)]
+        segment_attributes = [get_segments(roi_dict, codes)]
     else:
-        segment_attributes = [[get_segment(1, "Probability Map", colormap.colors[0])]]
+        segment_attributes = [[get_segment(1, "Probability Map", get_colormap().colors[0])]]
 
     basic_info = {
         "ContentCreatorName": "MARCOPACS",
@@ -89,16 +157,19 @@ def generate_metadata(roi_dict, series_description="Segmentation"):
 
     return basic_info
 
-def get_segments(roi_dict):
+def get_segments(roi_dict, codes=None):
+    colormap = get_colormap()
     segments = []
     i = 0
     for label, description in roi_dict.items():
-        segments.append(get_segment(label, description, colormap.colors[i % len(colormap.colors)]))
+        code = lookup_code(codes, label, description)
+        segments.append(get_segment(label, description, colormap.colors[i % len(colormap.colors)], code))
         i += 1
 
     return segments
 
-def get_segment(label, description, color):
+def get_segment(label, description, color, code=None):
+    code = code or {}
     return {
         # Make sure we are using a simple int (not a NumPy type)
         "labelID": int(label),
@@ -108,27 +179,65 @@ def get_segment(label, description, color):
         "SegmentAlgorithmName": "Automatic",
         # Snomed Coding for Tissue
         "SegmentedPropertyCategoryCodeSequence": {
-            "CodeValue": "85756007",
-            "CodingSchemeDesignator": "SCT",
-            "CodeMeaning": "",
+            "CodeValue": code.get("CategoryCodeValue") or CATEGORY_CODE_VALUE,
+            "CodingSchemeDesignator": code.get("CategoryCodingSchemeDesignator") or "SCT",
+            "CodeMeaning": code.get("CategoryCodeMeaning") or "",
         },
         # Snomed Coding for Organ
         "SegmentedPropertyTypeCodeSequence": {
-            "CodeValue": "",
-            "CodingSchemeDesignator": "SCT",
-            "CodeMeaning": "",
+            "CodeValue": code.get("CodeValue") or "",
+            "CodingSchemeDesignator": code.get("CodingSchemeDesignator") or "SCT",
+            "CodeMeaning": code.get("CodeMeaning") or "",
         },
         # Color to display
         "RecommendedDisplayCIELabValue": color,
     }
 
-def create_metadata(segmentation,csv_path,output_path):
 
-    lables = get_labels(segmentation,csv_path)
-    lable_map = parse_labelmap_file(csv_path,lables)
-    meta = generate_metadata(lable_map)
+# A code table path is read once, a dict is used as it is
+def _code_table(codes):
+    if isinstance(codes, (str, os.PathLike)):
+        return read_code_table(codes)
+    return codes
+
+
+def _write_metadata(label_names, labels, output_path, codes):
+    meta = generate_metadata(map_label_names(label_names, select_labels(labels, label_names)), codes=codes)
 
     # Convert and write JSON object to file
     with open(output_path, "w") as outfile:
-        json.dump(meta, outfile,indent=4)
-    print("metadata generated successfully")
\ No newline at end of file
+        json.dump(meta, outfile, indent=4)
+
+
+def create_metadata(segmentation, csv_path, output_path, labels=None, codes=None):
+    """Write the metadata JSON of a segmentation.
+
+    `segmentation` is a file path, a `LoadedSegmentation` or an array; pass
+    `labels` instead if the present labels are already known. `codes` is a
+    code lookup CSV (see `read_code_table`) or a dict of the same rows.
+    """
+    if labels is None:
+        labels = find_labels(segmentation)
+    _write_metadata(read_label_csv(csv_path), labels, output_path, _code_table(codes))
+    print("metadata generated successfully")
+
+
+def create_metadata_batch(segmentation_dir, csv_path, output_dir, codes=None, workers=None):
+    """Write `<name>.json` into `output_dir` for every NIfTI file in `segmentation_dir`.
+
+    The label CSV and code table are parsed once for the whole directory and
+    the files are read in `workers` threads. Returns {segmentation path: metadata path}.
+    """
+    label_names = read_label_csv(csv_path)
+    codes = _code_table(codes)
+    names = sorted(name for name in os.listdir(segmentation_dir) if name.endswith(SEGMENTATION_SUFFIXES))
+    os.makedirs(output_dir, exist_ok=True)
+
+    def convert(name):
+        stem = name[:-len(".nii.gz")] if name.endswith(".nii.gz") else os.path.splitext(name)[0]
+        output_path = os.path.join(output_dir, f"{stem}.json")
+        _write_metadata(label_names, find_labels(os.path.join(segmentation_dir, name)), output_path, codes)
+        return os.path.join(segmentation_dir, name), output_path
+
+    with ThreadPoolExecutor(workers) as pool:
+        return dict(pool.map(convert, names))
@@ -0,0 +1,316 @@
+import io
+import struct
+import zlib
+from concurrent.futures import Future
+
+import numpy as np
+import highdicom as hd
+from highdicom.frame import encode_frame
+from pydicom.charset import default_encoding
+from pydicom.encaps import generate_frames
+from pydicom.filereader import read_dataset
+from pydicom.tag import Tag
+
+from seg_writer.frames import BitPacker, foreground_value, frame_encoding, frame_item, segment_frame, sparse_template
+from seg_writer.hashes import get_segment_hashes, segment_hash, set_segment_hashes
+from seg_writer.labels import SLICE
+from seg_writer.streaming import encapsulated_pixel_chunks, native_pixel_chunks, sequence_chunks
+from seg_writer.utils import write_streamed
+
+_PER_FRAME_FUNCTIONAL_GROUPS_SEQUENCE = Tag(0x52009230)
+_PIXEL_DATA = Tag(0x7FE00010)
+_DERIVATION_IMAGE_SEQUENCE = 0x00089124
+_SOURCE_IMAGE_SEQUENCE = 0x00082112
+_REFERENCED_SOP_INSTANCE_UID = 0x00081155
+_FRAME_CONTENT_SEQUENCE = 0x00209111
+_DIMENSION_INDEX_VALUES = 0x00209157
+_SEGMENT_IDENTIFICATION_SEQUENCE = 0x0062000A
+_REFERENCED_SEGMENT_NUMBER = 0x0062000B
+
+# Value representations with a 4 byte value length in explicit VR little endian
+_LONG_LENGTH_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+_SEQUENCE_DELIMITER = 0xE0DD
+
+
+# Elements of one explicit VR little endian dataset as {tag: (value start, value end, items)}, and where it ends
+def _read_elements(data, offset, end):
+    """Scan the element headers of a dataset from `offset` to `end` or its item delimiter.
+
+    Values are not decoded. `items` holds the (start, end) span of every
+    item of a sequence or fragment of encapsulated pixel data, headers
+    included, and is None for other elements.
+    """
+    elements = {}
+    while offset < end:
+        group, element = struct.unpack_from('<HH', data, offset)
+        if group == 0xFFFE:
+            # Item delimiter of an undefined length item
+            return elements, offset + 8
+        vr = bytes(data[offset + 4:offset + 6])
+        if vr in _LONG_LENGTH_VRS:
+            length, = struct.unpack_from('<L', data, offset + 8)
+            value = offset + 12
+        else:
+            length, = struct.unpack_from('<H', data, offset + 6)
+            value = offset + 8
+        items = None
+        if length == _UNDEFINED_LENGTH:
+            items, offset = _read_items(data, value, end)
+        elif vr == b'SQ':
+            items, offset = _read_items(data, value, value + length)
+        else:
+            offset = value + length
+        elements[group << 16 | element] = (value, offset, items)
+    return elements, offset
+
+
+# (start, end) span of every item up to `end` or the sequence delimiter, and where the sequence ends
+def _read_items(data, offset, end):
+    items = []
+    while offset < end:
+        _, element, length = struct.unpack_from('<HHL', data, offset)
+        if element == _SEQUENCE_DELIMITER:
+            return items, offset + 8
+        if length == _UNDEFINED_LENGTH:
+            _, stop = _read_elements(data, offset + 8, end)
+        else:
+            stop = offset + 8 + length
+        items.append((offset, stop))
+        offset = stop
+    return items, offset
+
+
+# Value span of an element reached through the first item of each sequence tag on the way
+def _find(data, elements, *tags):
+    for tag in tags[:-1]:
+        start, stop = elements[tag][2][0]
+        elements, _ = _read_elements(data, start + 8, stop)
+    value, end, _ = elements[tags[-1]]
+    return value, end
+
+
+class PreviousSegmentation:
+    """Encoded frames, per-frame functional groups and segment hashes of a SEG written by seg_writer.
+
+    Only the elements before the per-frame functional groups are decoded;
+    items and frames are located in the (inflated) bytes of the file and
+    kept encoded, so an update copies them as they are and only rewrites
+    the dimension index values of copied items.
+    """
+
+    def __init__(self, data):
+        file = io.BytesIO(data)
+        if data[128:132] != b'DICM':
+            raise ValueError("The segmentation to update is not a DICOM file.")
+        file.seek(132)
+        meta = read_dataset(file, False, True, stop_when=lambda tag, vr, length: tag.group != 2)
+        self.transfer_syntax = meta.TransferSyntaxUID
+        if self.transfer_syntax.is_implicit_VR or not self.transfer_syntax.is_little_endian:
+            raise ValueError("Only DICOM SEG files written by seg_writer can be updated.")
+        if self.transfer_syntax.is_deflated:
+            data = zlib.decompress(data[file.tell():], -zlib.MAX_WBITS)
+            file = io.BytesIO(data)
+
+        dataset = read_dataset(file, False, True,
+                               stop_when=lambda tag, vr, length: tag >= _PER_FRAME_FUNCTIONAL_GROUPS_SEQUENCE)
+        self.hashes = get_segment_hashes(dataset)
+        if not self.hashes:
+            raise ValueError("The segmentation has no segment hashes, only DICOM SEG files written by seg_writer can be updated.")
+        self.segmentation_type = hd.seg.SegmentationTypeValues(dataset.SegmentationType)
+        self.frame_shape = (int(dataset.Rows), int(dataset.Columns))
+        self.bits_allocated = int(dataset.BitsAllocated)
+        frame_count = int(dataset.NumberOfFrames)
+
+        # With a single segment the identification is in the shared functional groups
+        shared = dataset.SharedFunctionalGroupsSequence[0].get('SegmentIdentificationSequence')
+        self.per_frame_identification = shared is None
+        self._data = memoryview(data)
+        self._items = []
+        self._frames = {}
+        try:
+            elements, _ = _read_elements(self._data, file.tell(), len(data))
+            for index, (start, stop) in enumerate(elements[_PER_FRAME_FUNCTIONAL_GROUPS_SEQUENCE][2]):
+                item, _ = _read_elements(self._data, start + 8, stop)
+                if _SEGMENT_IDENTIFICATION_SEQUENCE in item:
+                    value, _ = _find(self._data, item, _SEGMENT_IDENTIFICATION_SEQUENCE, _REFERENCED_SEGMENT_NUMBER)
+                    segment_number, = struct.unpack_from('<H', self._data, value)
+                else:
+                    segment_number = int(shared[0].ReferencedSegmentNumber)
+                value, end = _find(self._data, item, _DERIVATION_IMAGE_SEQUENCE, _SOURCE_IMAGE_SEQUENCE,
+                                   _REFERENCED_SOP_INSTANCE_UID)
+                sop_instance_uid = bytes(self._data[value:end]).rstrip(b'\x00 ').decode('ascii')
+                self._frames.setdefault(segment_number, {})[sop_instance_uid] = index
+                value, end = _find(self._data, item, _FRAME_CONTENT_SEQUENCE, _DIMENSION_INDEX_VALUES)
+                self._items.append((start, stop, value - start, (end - value) // 4))
+            pixel_start, pixel_end, fragments = elements[_PIXEL_DATA]
+        except (KeyError, IndexError, TypeError, struct.error) as ex:
+            raise ValueError(f"The frames of the segmentation to update can not be read: {ex!r}") from ex
+        if len(self._items) != frame_count:
+            raise ValueError(f"The segmentation to update has {frame_count} frames "
+                             f"but {len(self._items)} per-frame functional groups.")
+
+        self._encoded = None
+        self._pixels = None
+        if self.transfer_syntax.is_encapsulated:
+            # seg_writer stores every frame in one fragment, after the basic offset table
+            if len(fragments) == frame_count + 1:
+                self._encoded = [self._data[start + 8:stop] for start, stop in fragments[1:]]
+            else:
+                self._encoded = list(generate_frames(bytes(self._data[pixel_start:pixel_end]), number_of_frames=frame_count))
+        else:
+            self._pixels = self._data[pixel_start:pixel_end]
+
+    @classmethod
+    def from_file(cls, seg_file_path):
+        with open(seg_file_path, 'rb') as file:
+            return cls(file.read())
+
+    def segment_hash(self, segment_number):
+        return self.hashes.get(int(segment_number))
+
+    def frames(self, segment_number):
+        """Frame indices of a segment, keyed by the SOP Instance UID of their source image."""
+        return self._frames.get(int(segment_number), {})
+
+    @property
+    def pack_on_write(self):
+        """Whether bit-packed frames share bytes, so that they are packed again when written."""
+        return self.bits_allocated == 1 and self._pixels is not None and (self.frame_shape[0] * self.frame_shape[1]) % 8 != 0
+
+    def item(self, index, dimension_index_values):
+        """Encoded per-frame functional groups item of a frame, with new dimension index values."""
+        start, stop, offset, count = self._items[index]
+        if count != len(dimension_index_values):
+            raise ValueError(f"The frames of the segmentation to update have {count} dimension index values.")
+        item = bytearray(self._data[start:stop])
+        struct.pack_into(f'<{count}L', item, offset, *dimension_index_values)
+        return item
+
+    def frame(self, index):
+        """Encoded bytes of a frame as an update writes them.
+
+        Encapsulated frames and native frames are their stored bytes, except
+        that bit-packed frames not starting on a byte boundary are unpacked to
+        one byte per pixel, see `pack_on_write`.
+        """
+        if self._encoded is not None:
+            return self._encoded[index]
+        pixels = self.frame_shape[0] * self.frame_shape[1]
+        if self.bits_allocated != 1:
+            return self._pixels[index * pixels:(index + 1) * pixels]
+        first_bit = index * pixels
+        if not self.pack_on_write:
+            return self._pixels[first_bit // 8:(first_bit + pixels) // 8]
+        data = np.frombuffer(self._pixels, dtype=np.uint8, count=(first_bit + pixels + 7) // 8 - first_bit // 8,
+                             offset=first_bit // 8)
+        return np.unpackbits(data, bitorder='little')[first_bit % 8:first_bit % 8 + pixels].tobytes()
+
+
+class UpdatedSegmentation:
+    """A SEG built by an update, written from encoded per-frame functional groups items and frames.
+
+    `dataset` holds every other element; items are datasets or encoded
+    items, frames are encoded as `PreviousSegmentation.frame` returns them.
+    """
+
+    def __init__(self, dataset, items, frames, pack_on_write):
+        self.dataset = dataset
+        self.items = items
+        self.frames = frames
+        self.pack_on_write = pack_on_write
+
+    def write(self, output_file_path, transfer_syntax, compression_level=zlib.Z_DEFAULT_COMPRESSION):
+        """Write the SEG element by element with `write_streamed`."""
+        lengths = [len(frame) for frame in self.frames]
+        if self.dataset.file_meta.TransferSyntaxUID.is_encapsulated:
+            pixel_chunks = encapsulated_pixel_chunks(self.frames, lengths)
+        elif self.pack_on_write:
+            pixel_chunks = native_pixel_chunks(self.frames, (sum(lengths) + 7) // 8, BitPacker())
+        else:
+            pixel_chunks = native_pixel_chunks(self.frames, sum(lengths))
+        character_set = self.dataset.get('SpecificCharacterSet', default_encoding)
+        return write_streamed(self.dataset, output_file_path, transfer_syntax, compression_level, streamed={
+            _PER_FRAME_FUNCTIONAL_GROUPS_SEQUENCE: sequence_chunks(
+                _PER_FRAME_FUNCTIONAL_GROUPS_SEQUENCE, self.items, character_set
+            ),
+            _PIXEL_DATA: pixel_chunks,
+        })
+
+
+def create_updated_segmentation(previous, source_images, volume, segment_descriptions, transfer_syntax_uid,
+                                executor=None, label_index=None, **kwargs):
+    """Build the SEG a full conversion of a label volume gives, copying unchanged segments from `previous`.
+
+    Every segment is hashed first. The encoded frames and per-frame
+    functional groups items of segments whose hash matches the one stored in
+    `previous` are copied as they are, with new dimension index values;
+    only the frames of changed segments are built and encoded. Returns an
+    `UpdatedSegmentation`.
+    """
+    seg, label_index, segment_labels, indices = sparse_template(
+        source_images, volume, segment_descriptions, previous.segmentation_type, transfer_syntax_uid,
+        label_index, **kwargs,
+    )
+    segment_numbers = [int(desc.SegmentNumber) for desc in segment_descriptions]
+    frame_shape = volume.shape[1:]
+    template = seg.PerFrameFunctionalGroupsSequence[0]
+    del seg.PerFrameFunctionalGroupsSequence
+    del seg.PixelData
+
+    value = foreground_value(seg)
+    encapsulated = seg.file_meta.TransferSyntaxUID.is_encapsulated
+    encode_kwargs = frame_encoding(seg)
+    bit_packed = seg.BitsAllocated == 1 and not encapsulated
+    # Frames that do not fill whole bytes are packed while writing, as frames share bytes
+    pack_on_write = bit_packed and (frame_shape[0] * frame_shape[1]) % 8 != 0
+    plane_positions = {}
+    # Items hold the segment identification unless a SEG has a single segment, only SEGs that agree can share items
+    reusable = (_SEGMENT_IDENTIFICATION_SEQUENCE in template) == previous.per_frame_identification
+
+    items = []
+    frames = []
+    hashes = {}
+    for segment_index, (segment_number, label) in enumerate(zip(segment_numbers, segment_labels), 1):
+        entries = label_index.frames(label)
+        entries = sorted(entries.tolist(), key=lambda entry: indices[entry[SLICE]])
+        hashes[segment_number] = segment_hash(volume, entries, label, source_images)
+        reused = {}
+        if reusable and previous.segment_hash(segment_number) == hashes[segment_number]:
+            reused = previous.frames(segment_number)
+        for entry in entries:
+            slice_index = entry[SLICE]
+            dimension_index_values = (segment_index, indices[slice_index])
+            previous_index = reused.get(str(source_images[slice_index].SOPInstanceUID))
+            if previous_index is not None:
+                # Frames of an unchanged segment are copied as they are encoded
+                items.append(previous.item(previous_index, dimension_index_values))
+                frames.append(previous.frame(previous_index))
+                continue
+
+            if slice_index not in plane_positions:
+                plane_positions[slice_index] = hd.PlanePositionSequence(
+                    hd.CoordinateSystemNames.PATIENT, source_images[slice_index].ImagePositionPatient
+                )
+            items.append(frame_item(
+                template,
+                source_images[slice_index],
+                plane_positions[slice_index],
+                dimension_index_values,
+                segment_number,
+            ))
+            frame = segment_frame(volume, entry, label, frame_shape, value)
+            if encapsulated:
+                if executor is None:
+                    frames.append(encode_frame(frame, **encode_kwargs))
+                else:
+                    frames.append(executor.submit(encode_frame, frame, **encode_kwargs))
+            elif bit_packed and not pack_on_write:
+                frames.append(np.packbits(frame, bitorder='little').tobytes())
+            else:
+                frames.append(frame.tobytes())
+
+    set_segment_hashes(seg, hashes)
+    seg.NumberOfFrames = len(items)
+    frames = [frame.result() if isinstance(frame, Future) else frame for frame in frames]
+    return UpdatedSegmentation(seg, items, frames, pack_on_write)
@@ -1,20 +1,30 @@
-import SimpleITK as sitk
 import numpy as np
 from pathlib import Path
 import os
-import pydicom
 import importlib.util
-from pydicom.tag import Tag
-import nibabel as nib
+import zlib
+from seg_writer.lazy import LazyModule
+from seg_writer.orientation import reorient_to_dicom
+from seg_writer.series import SourceSeries
+from seg_writer.segmentation import LoadedSegmentation
+from seg_writer.labels import LabelIndex
+from seg_writer.catalog import display_color_value
+
+# Heavy dependencies are imported on first use
+sitk = LazyModule("SimpleITK")
+pydicom = LazyModule("pydicom")
+hd = LazyModule("highdicom")
 
 # Check for ovelap segments and validate file 
 def check_for_overlap(segmentation):
     """Check for overlap in segments and validate the file."""
     is_overlap = False 
-    if isinstance(segmentation, sitk.Image):
-        is_overlap = segmentation.GetNumberOfComponentsPerPixel() > 1
+    if isinstance(segmentation, LoadedSegmentation):
+        is_overlap = segmentation.components > 1
     elif isinstance(segmentation, np.ndarray):
-        segmentation = sitk.GetImageFromArray(segmentation)
+        # Components are read from the shape, the array is not copied
+        is_overlap = int(np.prod(segmentation.shape[3:], dtype=np.int64)) > 1
+    elif isinstance(segmentation, sitk.Image):
         is_overlap = segmentation.GetNumberOfComponentsPerPixel() > 1
     elif isinstance(segmentation, Path):
         try:
@@ -32,27 +42,27 @@ def check_for_overlap(segmentation):
 # Check shape of nifti with original dicom file
 def match_shape_segmentation_and_dicom(segmentation,dicom_series_path,dicom_datasets):
     """Check if the shape of the segmentation matches the shape of the original DICOM series."""
-    dicom_shape = len([dicom_series_path+ i for i in os.listdir(dicom_series_path) if '.dcm' in i])
+    dicom_shape = len(dicom_datasets)
     dicom_rows, dicom_columns = dicom_datasets[0].Rows, dicom_datasets[0].Columns
 
-    if segmentation.shape != (dicom_shape,dicom_rows,dicom_columns):
-        try:
-            # Ensure the NIfTI array has the same number of slices as the DICOM series
-            if segmentation.shape[0] != dicom_shape:
-                #Find the axis with the matching number of slices
-                slice_axis = np.argmax([segmentation.shape[0] == dicom_shape,
-                            segmentation.shape[1] == dicom_shape,
-                            segmentation.shape[2] == dicom_shape])
-            # Reorder the axes to match the DICOM shape (slices, rows, columns)
+    # A fourth axis (segments of a probability map) is kept as it is
+    if segmentation.shape[:3] != (dicom_shape,dicom_rows,dicom_columns):
+        # Ensure the array has the same number of slices as the DICOM series
+        if segmentation.shape[0] != dicom_shape and dicom_shape in segmentation.shape[:3]:
+            # Find the axis with the matching number of slices and move it first
+            slice_axis = segmentation.shape[:3].index(dicom_shape)
             segmentation = np.moveaxis(segmentation, slice_axis, 0)
-        except Exception as e:
-            if segmentation.shape[1] != dicom_rows or segmentation.shape[2] != dicom_columns:
-                raise ValueError(f"The shape of nifti file with {segmentation.shape} is incompatible with shape of source dicom series with {(dicom_shape,dicom_datasets[0].Rows,dicom_datasets[0].Columns)}")
+        if segmentation.shape[:3] != (dicom_shape,dicom_rows,dicom_columns):
+            raise ValueError(f"The shape of nifti file with {segmentation.shape} is incompatible with shape of source dicom series with {(dicom_shape,dicom_rows,dicom_columns)}")
     return segmentation
 # Check if labels present in input segmentation or not return labels if exists and return error if no labels found
 def get_nifti_labels(segmentation):
     """Check if labels are present in the input segmentation and return labels if they exist."""
-    if isinstance(segmentation, np.ndarray):
+    if isinstance(segmentation, LoadedSegmentation):
+        segmentation = segmentation.volume
+    if isinstance(segmentation, np.ndarray) and segmentation.ndim == 3 and segmentation.dtype.kind in 'biu':
+        labels = LabelIndex.from_volume(segmentation).labels
+    elif isinstance(segmentation, np.ndarray):
         labels = np.trim_zeros(np.unique(segmentation))
     elif isinstance(segmentation, str):
         sitk_image = sitk.ReadImage(str(segmentation))
@@ -66,17 +76,55 @@ def get_nifti_labels(segmentation):
     return labels
 
 
+# Validate a label map in one pass and index where each label is present
+def validate_label_map(segmentation, segment_numbers=None):
+    """Check a label map and return its `LabelIndex`.
+
+    Checks the data type and component count without copying the array,
+    that at least one label is present and, if `segment_numbers` is given,
+    that every label is described in the segmentation metadata. The index
+    holds the present labels with their voxel counts and bounding boxes and
+    can be passed on to `create_sparse_segmentation`.
+    """
+    check_for_overlap(segmentation)
+    if isinstance(segmentation, LoadedSegmentation):
+        segmentation = segmentation.volume
+    if segmentation.ndim > 3:
+        segmentation = segmentation.reshape(segmentation.shape[:3])
+    label_index = LabelIndex.from_volume(segmentation)
+    if label_index.entries.size == 0:
+        raise ValueError("No segments found for encoding as DICOM-SEG")
+    if segment_numbers is not None:
+        undescribed = sorted(set(label_index.labels.tolist()) - {int(number) for number in segment_numbers})
+        if undescribed:
+            raise ValueError(f"Labels {undescribed} of the segmentation are not described in the segmentation metadata.")
+    return label_index
+
+
+# Check a probability map used for a FRACTIONAL segmentation
+def check_probability_map(segmentation):
+    """Check that a probability map only holds values between 0 and 1."""
+    if isinstance(segmentation, LoadedSegmentation):
+        segmentation = segmentation.volume
+    if segmentation.size == 0 or segmentation.min() < 0 or segmentation.max() > 1:
+        raise ValueError("Probability maps for FRACTIONAL segmentations must contain values between 0 and 1.")
+
+
 # Test reading back
-def reading_back(output_file_path):
-    """Read the generated DICOM SEG file for final confirmation."""
+def reading_back(output_file_path, stop_before_pixels=False):
+    """Read the generated DICOM SEG file (or a seekable file-like object) for final confirmation."""
     try:
-        _ = pydicom.dcmread(str(output_file_path),force=True)
+        if is_file_like(output_file_path):
+            output_file_path.seek(0)
+        else:
+            output_file_path = str(output_file_path)
+        _ = pydicom.dcmread(output_file_path,force=True,stop_before_pixels=stop_before_pixels)
     except Exception as ex:
         print("DICOMSeg creation failed. Error:\n{}".format(ex))
 
 
 # Compress dicom seg file
-def compress_dicom(input_file_path: str, output_file_path: str):
+def compress_dicom(input_file_path: str, output_file_path: str, compression_level: int = zlib.Z_DEFAULT_COMPRESSION):
     """Compress a DICOM file using deflate."""
     ds = pydicom.dcmread(input_file_path)
 
@@ -84,12 +132,157 @@ def compress_dicom(input_file_path: str, output_file_path: str):
     if ds.file_meta.TransferSyntaxUID.is_compressed:
         ds.decompress()
 
-    ds.is_implicit_VR = False
-    ds.is_little_endian = True
-    ds.file_meta.TransferSyntaxUID = pydicom.uid.DeflatedExplicitVRLittleEndian
-
     # Save the compressed file
-    ds.save_as(output_file_path, write_like_original=False)
+    write_deflated(ds, output_file_path, compression_level)
+
+
+# Output encodings and the transfer syntax UID of the written file (kept as text so pydicom loads lazily)
+ENCODINGS = {
+    "deflate": "1.2.840.10008.1.2.1.99",  # DeflatedExplicitVRLittleEndian
+    "explicit": "1.2.840.10008.1.2.1",  # ExplicitVRLittleEndian
+    "rle": "1.2.840.10008.1.2.5",  # RLELossless
+    "jpegls": "1.2.840.10008.1.2.4.80",  # JPEGLSLossless
+    "jpeg2000": "1.2.840.10008.1.2.4.90",  # JPEG2000Lossless
+}
+
+
+# Segmentation types written by the per-segment builders; LABELMAP SEGs are a different storage class
+SEGMENTATION_TYPES = ("BINARY", "FRACTIONAL")
+
+
+# Resolve a segmentation type name (or highdicom value) to highdicom's value
+def segmentation_type_for(segmentation_type):
+    value = getattr(segmentation_type, "value", segmentation_type)
+    if value not in SEGMENTATION_TYPES:
+        raise ValueError(f"Unsupported segmentation type {value}, expected one of: {', '.join(SEGMENTATION_TYPES)}")
+    return hd.seg.SegmentationTypeValues(value)
+
+
+# Resolve an encoding name (or transfer syntax UID) to a transfer syntax
+def transfer_syntax_for(encoding):
+    if encoding in ENCODINGS.values():
+        return pydicom.uid.UID(encoding)
+    try:
+        return pydicom.uid.UID(ENCODINGS[str(encoding).lower()])
+    except KeyError:
+        raise ValueError(f"Unsupported encoding {encoding}, expected one of: {', '.join(ENCODINGS)}") from None
+
+
+# Frames of a deflated file are stored natively, the whole file is compressed afterwards
+def frame_transfer_syntax_for(transfer_syntax):
+    if transfer_syntax == pydicom.uid.DeflatedExplicitVRLittleEndian:
+        return pydicom.uid.ExplicitVRLittleEndian
+    return transfer_syntax
+
+
+# Writable file-like objects are written to directly, anything else is a path
+def is_file_like(output):
+    return hasattr(output, "write")
+
+
+# Write a dataset with its own transfer syntax, replacing the target only when complete
+def write_dicom(dataset, output_file_path):
+    if is_file_like(output_file_path):
+        dataset.save_as(output_file_path)
+        return output_file_path
+    temp_path = f"{output_file_path}.{os.getpid()}.tmp"
+    try:
+        dataset.save_as(temp_path)
+        os.replace(temp_path, output_file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return output_file_path
+
+
+# Serialize a dataset straight into a deflate stream
+def write_deflated(dataset, output_file_path, compression_level=zlib.Z_DEFAULT_COMPRESSION):
+    """Write `dataset` with DeflatedExplicitVRLittleEndian without an uncompressed intermediate file."""
+    return write_streamed(dataset, output_file_path, pydicom.uid.DeflatedExplicitVRLittleEndian, compression_level)
+
+
+# Serialize a dataset one top level element at a time
+def write_streamed(dataset, output_file_path, transfer_syntax=None, compression_level=zlib.Z_DEFAULT_COMPRESSION, streamed=None):
+    """Write `dataset` element by element, optionally deflating the stream.
+
+    `transfer_syntax` defaults to the one in `dataset.file_meta`. With
+    DeflatedExplicitVRLittleEndian each encoded element is fed to the
+    compressor, so only the largest single element is held uncompressed in
+    memory. `streamed` maps tags to iterables of already encoded bytes
+    (element header included) written in place of that element, which lets
+    large elements such as PixelData be produced piece by piece. The file is
+    written next to `output_file_path` and moved into place when complete;
+    a writable file-like object, e.g. a temporary file a caller moves into
+    place itself, is written to directly.
+    """
+    from pydicom.charset import default_encoding
+    from pydicom.filebase import DicomBytesIO
+    from pydicom.filewriter import correct_ambiguous_vr, write_data_element, write_file_meta_info
+
+    streamed = streamed or {}
+    transfer_syntax = pydicom.uid.UID(transfer_syntax or dataset.file_meta.TransferSyntaxUID)
+    file_meta = pydicom.dataset.FileMetaDataset(dataset.file_meta)
+    file_meta.TransferSyntaxUID = transfer_syntax
+    file_meta.MediaStorageSOPClassUID = dataset.SOPClassUID
+    file_meta.MediaStorageSOPInstanceUID = dataset.SOPInstanceUID
+
+    header = DicomBytesIO()
+    header.is_little_endian = True
+    header.is_implicit_VR = False
+    header.write(b"\x00" * 128 + b"DICM")
+    write_file_meta_info(header, file_meta, enforce_standard=True)
+
+    dataset = correct_ambiguous_vr(dataset, transfer_syntax.is_little_endian)
+    character_set = dataset.get("SpecificCharacterSet", default_encoding)
+    if "PixelData" in dataset and not transfer_syntax.is_encapsulated:
+        dataset["PixelData"].is_undefined_length = False
+
+    def write(file):
+        file.write(header.getvalue())
+        compressor = None
+        if transfer_syntax.is_deflated:
+            compressor = zlib.compressobj(compression_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        written = 0
+        tags = sorted(set(dataset.keys()) | {pydicom.tag.Tag(tag) for tag in streamed})
+        for tag in tags:
+            # do not write retired Group Length (see PS3.5, 7.2)
+            if tag.element == 0 and tag.group > 6:
+                continue
+            if tag in streamed:
+                chunks = streamed[tag]
+            else:
+                buffer = DicomBytesIO()
+                buffer.is_little_endian = transfer_syntax.is_little_endian
+                buffer.is_implicit_VR = transfer_syntax.is_implicit_VR
+                write_data_element(buffer, dataset.get_item(tag), character_set)
+                chunks = (buffer.getvalue(),)
+            for chunk in chunks:
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                file.write(chunk)
+                written += len(chunk)
+        if compressor is not None:
+            chunk = compressor.flush()
+            file.write(chunk)
+            written += len(chunk)
+            if written % 2:
+                file.write(b"\x00")
+
+    if is_file_like(output_file_path):
+        write(output_file_path)
+        return output_file_path
+
+    temp_path = f"{output_file_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as file:
+            write(file)
+        os.replace(temp_path, output_file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return output_file_path
 
     
 def find_package_directory(package_name='seg_writer'):
@@ -98,72 +291,46 @@ def find_package_directory(package_name='seg_writer'):
         return None
     return os.path.dirname(spec.origin)
 
+# Set the display color of each segment, matched by segment number
 def add_color(metadata,dicom_dataset):
-    for i in metadata:
-        for sequence in dicom_dataset.SegmentSequence:
-            RecommendedDisplayCIELabValue = Tag(0x0062,0x000D)
-            label = i["SegmentLabel"]
-            try:
-                color = (i["RecommendedDisplayCIELabValue"])
-            except KeyError:
-                color = (i["recommendedDisplayRGBValue"])
-
-            if label in sequence.SegmentLabel:
-                sequence.add_new(RecommendedDisplayCIELabValue,'US',value=color)
-                
-    return dicom_dataset
-
-
-def reorient_pixel_array(nifti_file_path, refrenced_ds_path):
-    # Read the DICOM series
-    dicom_reader = sitk.ImageSeriesReader()
-    dicom_file_names = dicom_reader.GetGDCMSeriesFileNames(refrenced_ds_path)
-    dicom_reader.SetFileNames(dicom_file_names)
-    dicom_sitk_image = dicom_reader.Execute()
-    dicom_array = sitk.GetArrayFromImage(dicom_sitk_image)
+    """Add RecommendedDisplayCIELabValue to the segments of `dicom_dataset` from metadata entries."""
+    colors = {int(i["labelID"]): display_color_value(i) for i in metadata}
+    for sequence in dicom_dataset.SegmentSequence:
+        color = colors.get(int(sequence.SegmentNumber))
+        if color is not None:
+            sequence.RecommendedDisplayCIELabValue = color
 
-    # Load NIfTI file
-    nifti_img = nib.load(nifti_file_path)
-    nifti_data = nifti_img.get_fdata()
-    affine_matrix = nifti_img.affine
-
-    # Get the shapes
-    nifti_shape = nifti_data.shape
-    dicom_shape = dicom_sitk_image.GetDepth()
+    return dicom_dataset
 
-    # Get slice positions from the DICOM metadata
-    dicom_positions = np.array([dicom_sitk_image.TransformIndexToPhysicalPoint((0, 0, i)) for i in range(dicom_shape)])
 
-    # Derive slice positions from the NIfTI affine matrix
-    nifti_positions = np.array([affine_matrix @ np.array([0, 0, i, 1]) for i in range(nifti_shape[2])])[:, :3]
+def reorient_pixel_array(segmentation, source_series):
+    """Reorient a NIfTI segmentation to the (slices, rows, columns) grid of the source DICOM series."""
+    if not isinstance(segmentation, LoadedSegmentation):
+        segmentation = LoadedSegmentation.from_file(segmentation)
+    if not isinstance(source_series, SourceSeries):
+        source_series = SourceSeries.from_sources(source_series)
 
-    # Create an array to hold the segmented data and reorient based on the slice axis
-    slice_axis = np.argmax([nifti_shape[0] == dicom_shape,
-                            nifti_shape[1] == dicom_shape,
-                            nifti_shape[2] == dicom_shape])
-    
-    segment_array = np.zeros(dicom_array.shape,dtype=np.uint8)
+    # Map the NIfTI voxel grid onto the DICOM grid using both affines
+    return reorient_to_dicom(segmentation.volume, segmentation.affine, source_series.affine, source_series.size)
 
-    if slice_axis == 1:
-        for i in range(nifti_data.shape[1]):
-            for x in range(nifti_data.shape[0]):
-                for y in range(nifti_data.shape[2]):
-                    segment_array[i, x, y] = nifti_data[x, i, y]
 
-    elif slice_axis == 2:
-        for i in range(nifti_data.shape[2]):
-            for x in range(nifti_data.shape[0]):
-                for y in range(nifti_data.shape[1]):
-                    segment_array[i, x, y] = nifti_data[x, y, i]
+def resample_pixel_array(segmentation, source_series, interpolation="nearest", workers=None):
+    """Map a NIfTI segmentation of any grid onto the (slices, rows, columns) grid of the source DICOM series.
 
-    else:
-        segment_array = nifti_data
-    
-    # Compare first and last slice positions
-    if np.linalg.norm(nifti_positions[0] - dicom_positions[0]) > np.linalg.norm(nifti_positions[-1] - dicom_positions[0]):
-        segment_array = segment_array[::-1]
+    Grids that only differ in axis order and direction are reoriented
+    without copying, like `reorient_pixel_array`; any other grid is
+    resampled with `resample_to_dicom`.
+    """
+    from seg_writer.resample import check_interpolation, resample_to_dicom
 
-    # Rotate the segment array as needed
-    segment_array = np.rot90(segment_array, k=1, axes=(1, 2))
+    check_interpolation(interpolation)
+    if not isinstance(segmentation, LoadedSegmentation):
+        segmentation = LoadedSegmentation.from_file(segmentation)
+    if not isinstance(source_series, SourceSeries):
+        source_series = SourceSeries.from_sources(source_series)
 
-    return segment_array
\ No newline at end of file
+    try:
+        return reorient_to_dicom(segmentation.volume, segmentation.affine, source_series.affine, source_series.size)
+    except ValueError:
+        return resample_to_dicom(segmentation.volume, segmentation.affine, source_series.affine, source_series.size,
+                                 interpolation, workers)
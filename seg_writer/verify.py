@@ -0,0 +1,256 @@
+import os
+import struct
+
+import numpy as np
+
+from seg_writer.lazy import LazyModule
+from seg_writer.labels import LABEL, LabelIndex
+
+pydicom = LazyModule("pydicom")
+
+# Verification modes of a written DICOM SEG
+VERIFY_OFF = "off"
+VERIFY_FAST = "fast"
+VERIFY_FULL = "full"
+VERIFY_MODES = (VERIFY_OFF, VERIFY_FAST, VERIFY_FULL)
+
+_SEGMENTATION_STORAGE = "1.2.840.10008.5.1.4.1.1.66.4"
+_DERIVATION_IMAGE_SEQUENCE = 0x00089124
+_SOURCE_IMAGE_SEQUENCE = 0x00082112
+_REFERENCED_SOP_INSTANCE_UID = 0x00081155
+_SEGMENT_IDENTIFICATION_SEQUENCE = 0x0062000A
+_REFERENCED_SEGMENT_NUMBER = 0x0062000B
+
+# Bytes at the end of the pixel data compared with the end of a written file
+PIXEL_DATA_TAIL = 64
+
+
+class VerificationError(ValueError):
+    """A written DICOM SEG does not match what was meant to be written."""
+
+
+def check_verify_mode(mode):
+    if mode not in VERIFY_MODES:
+        raise ValueError(f"Unknown verification mode {mode!r}, use one of {', '.join(VERIFY_MODES)}.")
+    return mode
+
+
+# Open a written file, or rewind a file-like object, for reading
+def _open(target):
+    if hasattr(target, "read"):
+        target.seek(0)
+        return target
+    return open(target, "rb")
+
+
+def check_file(target, transfer_syntax, seg=None):
+    """Check the preamble and file meta information of a written SEG without reading its dataset.
+
+    Returns the file meta information.
+    """
+    file = _open(target)
+    try:
+        preamble = file.read(132)
+        if len(preamble) < 132 or preamble[128:] != b"DICM":
+            raise VerificationError("The written SEG has no DICOM preamble.")
+        try:
+            meta = pydicom.filereader.read_dataset(file, False, True, stop_when=lambda tag, vr, length: tag.group != 2)
+        except Exception as ex:
+            raise VerificationError(f"The file meta information of the written SEG can not be read: {ex}") from ex
+    finally:
+        if file is not target:
+            file.close()
+
+    if meta.get("TransferSyntaxUID") != transfer_syntax:
+        raise VerificationError(f"The written SEG has transfer syntax {meta.get('TransferSyntaxUID')}, not {transfer_syntax}.")
+    if meta.get("MediaStorageSOPClassUID") != _SEGMENTATION_STORAGE:
+        raise VerificationError(f"The written file is stored as {meta.get('MediaStorageSOPClassUID')}, not as a segmentation.")
+    if seg is not None:
+        if meta.get("MediaStorageSOPInstanceUID") != seg.SOPInstanceUID:
+            raise VerificationError("The SOP Instance UID of the written SEG does not match its dataset.")
+        if not pydicom.uid.UID(transfer_syntax).is_deflated and not _ends_with_pixel_data(target, seg.PixelData):
+            raise VerificationError("The written SEG does not end with its pixel data, the file is incomplete.")
+    return meta
+
+
+# PixelData is the last element and written as it is unless deflated, so a truncated file ends with other bytes
+def _ends_with_pixel_data(target, pixel_data):
+    tail = bytes(pixel_data[-PIXEL_DATA_TAIL:])
+    file = _open(target)
+    try:
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        # Room for a padding byte and the sequence delimiter of encapsulated pixel data
+        file.seek(max(size - len(tail) - 9, 0))
+        return tail in file.read()
+    finally:
+        if file is not target:
+            file.close()
+
+
+# Number of frames held by the PixelData of a segmentation
+def _pixel_data_frames(seg):
+    pixel_data = seg.PixelData
+    if seg.file_meta.TransferSyntaxUID.is_encapsulated:
+        # The basic offset table is the first item, every following fragment is one frame
+        offset_table_length = struct.unpack("<I", pixel_data[4:8])[0]
+        return pydicom.encaps.parse_fragments(pixel_data[8 + offset_table_length:])[0]
+    bits = len(pixel_data) * 8
+    frame_bits = int(seg.Rows) * int(seg.Columns) * int(seg.BitsAllocated)
+    frames = bits // frame_bits
+    # Bit-packed frames are padded to whole bytes and native PixelData to an even length
+    return frames if bits - frames * frame_bits < 16 else None
+
+
+def check_structure(seg, source_images, frame_counts=None):
+    """Check the frame count and the references of every frame of a SEG dataset.
+
+    Every frame has to refer to one source image of the series and one
+    described segment, with no (segment, source image) pair twice.
+    `frame_counts` optionally gives the number of frames expected per segment
+    number.
+    """
+    frames = int(seg.NumberOfFrames)
+    items = seg.PerFrameFunctionalGroupsSequence
+    if len(items) != frames:
+        raise VerificationError(f"The SEG has {frames} frames but {len(items)} per-frame functional groups.")
+    pixel_frames = _pixel_data_frames(seg)
+    if pixel_frames != frames:
+        raise VerificationError(f"The pixel data of the SEG does not hold its {frames} frames.")
+
+    source_uids = {str(image.SOPInstanceUID): index for index, image in enumerate(source_images)}
+    referenced = seg.ReferencedSeriesSequence[0].ReferencedInstanceSequence
+    if {str(item.ReferencedSOPInstanceUID) for item in referenced} != set(source_uids):
+        raise VerificationError("The SEG does not reference every image of the source series.")
+
+    segment_numbers = {int(description.SegmentNumber) for description in seg.SegmentSequence}
+    counts = {}
+    for index, (segment_number, slice_index) in enumerate(frame_references(seg, source_uids)):
+        if segment_number not in segment_numbers:
+            raise VerificationError(f"Frame {index + 1} refers to segment {segment_number}, which is not described.")
+        if slice_index is None:
+            raise VerificationError(f"Frame {index + 1} does not refer to an image of the source series.")
+        frames_of_segment = counts.setdefault(segment_number, set())
+        if slice_index in frames_of_segment:
+            raise VerificationError(f"Segment {segment_number} has more than one frame on source image {slice_index}.")
+        frames_of_segment.add(slice_index)
+
+    if frame_counts is not None:
+        for segment_number in segment_numbers:
+            found = len(counts.get(segment_number, ()))
+            if found != frame_counts.get(segment_number, 0):
+                raise VerificationError(
+                    f"Segment {segment_number} has {found} frames instead of {frame_counts.get(segment_number, 0)}."
+                )
+
+
+# Value of an element looked up by tag, which is much faster than by keyword
+def _value(dataset, tag):
+    element = dataset.get(tag)
+    return element.value if element is not None else None
+
+
+def frame_references(seg, source_uids):
+    """(segment number, source slice index) of every frame; the index is None for unknown source images."""
+    shared = _value(seg.SharedFunctionalGroupsSequence[0], _SEGMENT_IDENTIFICATION_SEQUENCE)
+    for item in seg.PerFrameFunctionalGroupsSequence:
+        identification = _value(item, _SEGMENT_IDENTIFICATION_SEQUENCE) or shared
+        derivations = _value(item, _DERIVATION_IMAGE_SEQUENCE) or []
+        sources = []
+        if len(derivations) == 1:
+            sources = _value(derivations[0], _SOURCE_IMAGE_SEQUENCE) or []
+        if not identification or len(sources) != 1:
+            raise VerificationError("A frame of the SEG does not refer to exactly one segment and source image.")
+        yield (int(_value(identification[0], _REFERENCED_SEGMENT_NUMBER)),
+               source_uids.get(str(_value(sources[0], _REFERENCED_SOP_INSTANCE_UID))))
+
+
+def check_frames(seg, source_images, volume, labels=None, label_index=None):
+    """Decode every frame of a SEG read back from its file and compare it with the converted volume.
+
+    `labels` maps segment number `n` to label `labels[n - 1]` of a label
+    map, by default segments are numbered by their label. Every voxel of a
+    described label has to be in a frame of its segment. Frames of a
+    probability map, one channel per segment on the last axis, may differ by
+    one step of the fractional value.
+    """
+    pixels = seg.pixel_array
+    if int(seg.NumberOfFrames) == 1:
+        pixels = pixels[np.newaxis]
+    source_uids = {str(image.SOPInstanceUID): index for index, image in enumerate(source_images)}
+    segment_numbers = [int(description.SegmentNumber) for description in seg.SegmentSequence]
+
+    if volume.ndim == 3:
+        label_of = {number: (labels[number - 1] if labels is not None else number) for number in segment_numbers}
+        found = dict.fromkeys(segment_numbers, 0)
+        for index, (segment_number, slice_index) in enumerate(frame_references(seg, source_uids)):
+            mask = pixels[index] != 0
+            if not np.array_equal(mask, volume[slice_index] == label_of[segment_number]):
+                raise VerificationError(f"Frame {index + 1} of segment {segment_number} does not match the label map.")
+            found[segment_number] += int(np.count_nonzero(mask))
+        if label_index is None:
+            label_index = LabelIndex.from_volume(volume)
+        voxel_counts = label_index.voxel_counts()
+        for segment_number, count in found.items():
+            if count != voxel_counts.get(label_of[segment_number], 0):
+                raise VerificationError(f"Segment {segment_number} is missing voxels of label {label_of[segment_number]}.")
+        return
+
+    maximum = int(seg.get("MaximumFractionalValue", 1))
+    channel_of = {number: channel for channel, number in enumerate(segment_numbers)}
+    expected = np.round(volume * maximum)
+    present = set()
+    for index, (segment_number, slice_index) in enumerate(frame_references(seg, source_uids)):
+        channel = channel_of[segment_number]
+        difference = np.abs(pixels[index].astype(np.int32) - expected[slice_index, ..., channel])
+        if difference.max(initial=0) > 1:
+            raise VerificationError(f"Frame {index + 1} of segment {segment_number} does not match the probability map.")
+        present.add((slice_index, channel))
+    # Frames of a (slice, segment) holding only the lowest fractional step may be omitted
+    needed = expected.reshape(expected.shape[0], -1, expected.shape[-1]).max(axis=1) > 1
+    for slice_index, channel in zip(*np.nonzero(needed)):
+        if (int(slice_index), int(channel)) not in present:
+            raise VerificationError(f"Segment {segment_numbers[channel]} has no frame on source image {slice_index}.")
+
+
+def verify_segmentation(target, mode, transfer_syntax, source_images, seg=None, volume=None, labels=None,
+                        label_index=None):
+    """Verify a written SEG, raising a `VerificationError` if it does not check out.
+
+    `"fast"` checks the preamble and file meta information and, when the
+    SEG dataset `seg` is still in memory, its frame count and frame
+    references, without reading the file any further. `"full"` reads the
+    file back, checks it the same way and compares every decoded frame with
+    `volume`, which may also be a callable loading it. `labels` and
+    `label_index` are as in `check_frames`; the label index also gives the
+    expected number of frames of every segment.
+    """
+    if mode == VERIFY_OFF:
+        return
+    frame_counts = None
+    if label_index is not None:
+        # A label has one frame on every slice it is found on
+        present, counts = np.unique(label_index.entries[:, LABEL], return_counts=True)
+        frame_counts = dict(zip(present.tolist(), counts.tolist()))
+        if labels is not None:
+            frame_counts = {number: frame_counts.get(int(label), 0) for number, label in enumerate(labels, 1)}
+
+    check_file(target, transfer_syntax, seg)
+    if seg is not None:
+        check_structure(seg, source_images, frame_counts)
+    if mode != VERIFY_FULL:
+        return
+
+    file = _open(target)
+    try:
+        written = pydicom.dcmread(file)
+    except Exception as ex:
+        raise VerificationError(f"The written SEG can not be read back: {ex}") from ex
+    finally:
+        if file is not target:
+            file.close()
+    check_structure(written, source_images, frame_counts)
+    if callable(volume):
+        volume = volume()
+    if volume is not None:
+        check_frames(written, source_images, volume, labels, label_index)
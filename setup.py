@@ -20,6 +20,9 @@ setup(
         'scikit-image'
 
     ],
+    entry_points={
+        'console_scripts': ['seg_writer=seg_writer.__main__:main'],
+    },
     package_data={
         '': ['./examples/*/*.json']
     }